@@ -0,0 +1,140 @@
+"""
+Time each preprocessing function on synthetic data at several scales.
+
+Synthetic inputs are generated once per scale under
+<base_path>/benchmark/<scale> (see synthetic.py), and each function is
+run `repeat` times on the output of the stage before it. Best and median
+wall times are written to <base_path>/benchmark/benchmark_results.csv,
+one row per scale and function, so runs can be compared over time.
+
+Usage:
+    python benchmark.py [scale ...] [--repeat N]
+
+Written by Ed Oughton
+
+"""
+import os
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+import preprocess
+import synthetic
+from profiling import count_records
+
+
+def time_call(func, args, kwargs, repeat):
+    """
+    Call `func` `repeat` times, returning its result and its best and
+    median wall times in seconds.
+
+    """
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+
+    return result, min(timings), float(np.median(timings))
+
+
+def benchmark_preprocess(data_path, scale, repeat=3):
+    """
+    Run the preprocessing functions in pipeline order on the synthetic
+    data under `data_path`, and return one timing row per function.
+
+    """
+    preprocess.DATA_RAW = os.path.join(data_path, 'raw')
+    results = []
+
+    def run(func, *args, **kwargs):
+        result, best, median = time_call(func, args, kwargs, repeat)
+        results.append({
+            'scale': scale,
+            'function': func.__name__,
+            'records_in': count_records(args[0]) if args else None,
+            'records_out': count_records(result),
+            'best_s': round(best, 4),
+            'median_s': round(median, 4),
+        })
+        return result
+
+    lads = run(preprocess.read_lads)
+    lad_lut = list(preprocess.lad_lut(lads))
+
+    postcode_sectors = run(
+        preprocess.read_postcode_sectors,
+        os.path.join(preprocess.DATA_RAW, 'shapes', 'PostalSector.shp'),
+        )
+    postcode_sectors = run(
+        preprocess.add_lad_to_postcode_sector, postcode_sectors, lads
+        )
+
+    weights = run(preprocess.load_in_weights)
+    coverage = run(preprocess.read_coverage_table, use_cache=False)
+
+    postcode_sectors = run(
+        preprocess.add_weights_to_postcode_sector, postcode_sectors, weights
+        )
+    postcode_sectors = run(preprocess.calculate_lad_population, postcode_sectors)
+
+    forecast = synthetic.synthetic_forecast(lad_lut)
+    run(preprocess.disaggregate, forecast, postcode_sectors)
+
+    with tempfile.TemporaryDirectory() as directory:
+        run(
+            preprocess.write_disaggregated, forecast, postcode_sectors,
+            directory, 'disaggregated.csv'
+            )
+
+    run(
+        preprocess.allocate_4G_coverage_scenarios,
+        postcode_sectors, lad_lut, coverage
+        )
+    postcode_sectors = run(
+        preprocess.allocate_4G_coverage, postcode_sectors, lad_lut, coverage
+        )
+
+    sites = run(
+        preprocess.import_sitefinder_data,
+        os.path.join(preprocess.DATA_RAW, 'sitefinder', 'sitefinder.csv'),
+        )
+    sites = run(preprocess.process_asset_data, sites)
+    sites = run(preprocess.add_coverage_to_sites, sites, postcode_sectors)
+
+    exchanges = list(preprocess.read_exchanges())
+    run(preprocess.generate_link_straight_line, sites, exchanges)
+
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        'scales', nargs='*', default=['1x', '10x', 'national'],
+        help='named scales from synthetic.SCALES, or fractions of national'
+        )
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    directory = os.path.join(preprocess.BASE_PATH, 'benchmark')
+
+    results = []
+
+    for scale in args.scales:
+        data_path = os.path.join(directory, scale)
+
+        if not os.path.exists(os.path.join(data_path, 'raw')):
+            print('Generating {} synthetic data'.format(scale))
+            synthetic.generate(data_path, scale)
+
+        print('Benchmarking preprocess at {}'.format(scale))
+        for row in benchmark_preprocess(data_path, scale, args.repeat):
+            print('- {function}: {best_s}s best, {median_s}s median'.format(**row))
+            results.append(row)
+
+    preprocess.csv_writer(results, directory, 'benchmark_results.csv')
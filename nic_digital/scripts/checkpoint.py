@@ -0,0 +1,369 @@
+"""
+Content-hashed checkpointing of pipeline stage outputs.
+
+Written by Ed Oughton
+
+"""
+import os
+import hashlib
+import inspect
+import pickle
+from collections.abc import Mapping
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+from coverage import CoverageTable
+from geometry_cache import file_signature
+from sectors import PostcodeSectors
+from sites import Links, Sites
+
+TABLES = dict((table.__name__, table) for table in (PostcodeSectors, Sites, Links))
+
+
+class StageCache(object):
+    """
+    Cache of stage outputs, keyed by a hash of the stage function's
+    source, its arguments and its parameters.
+
+    Table outputs (PostcodeSectors, Sites, Links, or a tuple of them)
+    are stored as `.npz` files with geometry packed as WKB. Anything
+    else is pickled.
+
+    Outputs returned by the cache remember the key of the stage that
+    made them. When one is passed on to a later stage, that key is
+    hashed in place of its contents, so a stage's key depends on its
+    upstream stage keys and raw inputs. A change to one raw input (new
+    population weights, say) then only reruns the stages downstream of
+    it, and unchanged stages are matched without rehashing their data.
+
+    Keyword arguments named in `ignore` only change how a stage runs,
+    not what it returns (the number of `workers`, say), so they are
+    left out of the key.
+
+    """
+    def __init__(self, directory, enabled=True, ignore=('workers',)):
+        self.directory = directory
+        self.enabled = enabled
+        self.ignore = frozenset(ignore)
+        self.last_hit = False
+        self.outputs = {}
+
+
+    def run(self, func, *args, **kwargs):
+        """
+        Return `func(*args, **kwargs)`, loading it from the cache if an
+        output with the same key exists, and storing it otherwise.
+        `last_hit` records whether the output was loaded.
+
+        """
+        self.last_hit = False
+
+        if not self.enabled:
+            return func(*args, **kwargs)
+
+        hashed = dict(
+            (name, value) for name, value in kwargs.items()
+            if name not in self.ignore
+            )
+        key = '{}-{}'.format(
+            func.__name__, stage_key(func, args, hashed, self.output_key)
+            )
+        path = os.path.join(self.directory, key)
+
+        if os.path.exists(path + '.npz'):
+            self.last_hit = True
+            return self.remember(load_tables(path + '.npz'), key)
+
+        if os.path.exists(path + '.pkl'):
+            self.last_hit = True
+            with open(path + '.pkl', 'rb') as source:
+                return self.remember(pickle.load(source), key)
+
+        result = func(*args, **kwargs)
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        if is_table_result(result):
+            save_tables(path + '.npz', result)
+        else:
+            with open(path + '.pkl.tmp', 'wb') as sink:
+                pickle.dump(result, sink, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.pkl.tmp', path + '.pkl')
+
+        return self.remember(result, key)
+
+
+    def remember(self, result, key):
+        """
+        Record `key` as the provenance of a table, list or dict `result`,
+        and of each item of a tuple of tables, and return `result`.
+        Scalars are shared objects, so they are never recorded.
+
+        The outputs are held for the life of the cache, so their ids
+        cannot be reused by other objects.
+
+        """
+        if not (isinstance(result, (list, dict)) or is_table_result(result)):
+            return result
+
+        self.outputs[id(result)] = (result, key)
+
+        if isinstance(result, tuple):
+            for i, item in enumerate(result):
+                self.outputs[id(item)] = (item, '{}/{}'.format(key, i))
+
+        return result
+
+
+    def output_key(self, value):
+        """
+        Return the key of the stage which produced `value`, or None if
+        it was not returned by this cache.
+
+        """
+        entry = self.outputs.get(id(value))
+
+        if entry is not None and entry[0] is value:
+            return entry[1]
+
+        return None
+
+
+def stage_key(func, args, kwargs, output_key=None):
+    """
+    Hash a stage function's source, and the source it depends on (see
+    `dependency_sources`), together with its arguments.
+
+    `output_key` maps an argument to the key of the stage which produced
+    it, or None, and keyed arguments are hashed by that key alone.
+
+    """
+    digest = hashlib.sha256()
+    digest.update('{}.{}'.format(func.__module__, func.__qualname__).encode())
+
+    for source in dependency_sources(func, list(args) + list(kwargs.values())):
+        digest.update(source)
+
+    fingerprint(list(args), digest, output_key)
+    fingerprint(dict(kwargs), digest, output_key)
+
+    return digest.hexdigest()[:20]
+
+
+def dependency_sources(func, args=()):
+    """
+    Return the source of a stage function and of the code it depends on,
+    as a list of bytes.
+
+    This is the source of the stage, of every function or class in its
+    own module that it refers to (followed transitively), and the full
+    contents of every local module (one in the same directory as the
+    stage) used by any of them, defining the class of one of `args`, or
+    used by those modules in turn. An edit to a helper such as
+    `spatial.cluster_points` or a table method then changes the key.
+
+    """
+    module = inspect.getmodule(func)
+    directory = local_directory(module)
+
+    sources = []
+    local_modules = set(
+        owner for owner in (inspect.getmodule(type(arg)) for arg in args)
+        if owner is not None and owner is not module and
+        local_directory(owner) == directory
+        )
+    seen = set()
+    stack = [func]
+
+    while stack:
+        item = stack.pop()
+        if item in seen:
+            continue
+        seen.add(item)
+
+        try:
+            sources.append(inspect.getsource(item).encode())
+        except (OSError, TypeError):
+            sources.append(item.__code__.co_code)
+
+        if not inspect.isfunction(item):
+            continue
+
+        for name in code_names(item.__code__):
+            value = item.__globals__.get(name)
+            owner = value if inspect.ismodule(value) else inspect.getmodule(value)
+
+            if owner is None or local_directory(owner) != directory:
+                continue
+            if owner is module:
+                if inspect.isfunction(value) or inspect.isclass(value):
+                    stack.append(value)
+            else:
+                local_modules.add(owner)
+
+    # Local modules are hashed whole, with the local modules they use.
+    modules = list(local_modules)
+    while modules:
+        for value in list(vars(modules.pop()).values()):
+            owner = value if inspect.ismodule(value) else inspect.getmodule(value)
+            if owner is not None and owner is not module and \
+                owner not in local_modules and \
+                local_directory(owner) == directory:
+                local_modules.add(owner)
+                modules.append(owner)
+
+    for path in sorted(os.path.abspath(owner.__file__) for owner in local_modules):
+        with open(path, 'rb') as source:
+            sources.append(source.read())
+
+    return sources
+
+
+def local_directory(module):
+    """
+    Return the directory holding a module's source file, or None.
+
+    """
+    path = getattr(module, '__file__', None)
+
+    if path is None:
+        return None
+
+    return os.path.dirname(os.path.abspath(path))
+
+
+def code_names(code):
+    """
+    Return the global names used by a code object and any code nested in
+    it (lambdas, comprehensions and inner functions).
+
+    """
+    names = set(code.co_names)
+
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names.update(code_names(const))
+
+    return names
+
+
+def fingerprint(value, digest, output_key=None):
+    """
+    Feed a stable description of `value` into a hashlib digest.
+
+    Tables and coverage data are hashed by their arrays, geometries by
+    their WKB, and paths to existing files by the size and mtime of the
+    file and any shapefile sidecars.
+    Values with a key from `output_key` are hashed by that key.
+    Generators cannot be hashed without being consumed, so pass lists.
+
+    """
+    key = None if output_key is None else output_key(value)
+
+    if key is not None:
+        digest.update(b'stage:' + key.encode())
+
+    elif value is None or isinstance(value, (bool, int, float)):
+        digest.update(repr(value).encode())
+
+    elif isinstance(value, str):
+        digest.update(b'str:' + value.encode())
+        if os.path.isfile(value):
+            digest.update(file_signature(value).encode())
+
+    elif isinstance(value, np.ndarray):
+        digest.update('{}{}'.format(value.dtype, value.shape).encode())
+        if value.dtype == object:
+            for item in value:
+                fingerprint(item, digest, output_key)
+        else:
+            digest.update(np.ascontiguousarray(value).tobytes())
+
+    elif hasattr(value, 'to_arrays'):
+        digest.update(type(value).__name__.encode())
+        for name, array in sorted(value.to_arrays().items()):
+            digest.update(name.encode())
+            fingerprint(array, digest)
+
+    elif isinstance(value, CoverageTable):
+        fingerprint(value.lad_ids, digest)
+        fingerprint(list(value.columns), digest)
+        fingerprint(value.values, digest)
+
+    elif isinstance(value, shapely.Geometry):
+        digest.update(shapely.to_wkb(value))
+
+    elif isinstance(value, Mapping):
+        if 'coordinates' in value and 'type' in value:
+            digest.update(shapely.to_wkb(shape(value)))
+        else:
+            for name in sorted(value, key=str):
+                fingerprint(name, digest, output_key)
+                fingerprint(value[name], digest, output_key)
+
+    elif isinstance(value, (list, tuple)):
+        digest.update('{}:{}'.format(type(value).__name__, len(value)).encode())
+        for item in value:
+            fingerprint(item, digest, output_key)
+
+    elif inspect.isgenerator(value):
+        raise TypeError('cannot fingerprint a generator, pass a list instead')
+
+    else:
+        digest.update(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def is_table_result(result):
+    """
+    Return True if `result` is a table or a tuple of tables.
+
+    """
+    if isinstance(result, tuple):
+        return len(result) > 0 and all(is_table_result(item) for item in result)
+
+    return isinstance(result, tuple(TABLES.values()))
+
+
+def save_tables(path, result):
+    """
+    Write a table, or a tuple of tables, to one `.npz` file.
+
+    """
+    tables = result if isinstance(result, tuple) else (result,)
+
+    arrays = {
+        '__types__': np.array([type(table).__name__ for table in tables]),
+        '__tuple__': np.array(isinstance(result, tuple)),
+    }
+    for i, table in enumerate(tables):
+        for name, array in table.to_arrays().items():
+            arrays['{}/{}'.format(i, name)] = array
+
+    with open(path + '.tmp', 'wb') as sink:
+        np.savez(sink, **arrays)
+    os.replace(path + '.tmp', path)
+
+
+def load_tables(path):
+    """
+    Read a table, or a tuple of tables, written by `save_tables`.
+
+    """
+    with np.load(path) as source:
+        types = source['__types__'].tolist()
+        tables = []
+        for i, name in enumerate(types):
+            prefix = '{}/'.format(i)
+            arrays = dict(
+                (key[len(prefix):], source[key])
+                for key in source.files if key.startswith(prefix)
+                )
+            tables.append(TABLES[name].from_arrays(arrays))
+
+        if bool(source['__tuple__']):
+            return tuple(tables)
+
+    return tables[0]
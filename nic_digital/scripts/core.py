@@ -11,40 +11,73 @@ import csv
 import fiona
 import time
 
+import numpy as np
+import shapely
 from shapely.geometry import shape, Point, LineString, mapping
-from shapely.ops import  cascaded_union
-import networkx as nx
-
-from rtree import index
 
 from collections import OrderedDict
 
+from geometry_cache import GeometryCache
+from spatial import euclidean_mst, nearest_pairs
+
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
 BASE_PATH = CONFIG['file_locations']['base_path']
+CACHE_PATH = CONFIG.get('file_locations', 'cache_path', fallback='cache')
 
 DATA_RAW = os.path.join(BASE_PATH, 'raw')
 DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
 
 
-def read_existing_nodes(path):
+def read_existing_nodes(path, geometry_cache=None):
     """
     Load in the existing node data.
 
+    With a GeometryCache, the nodes are read from its cached copy of the
+    shapefile. Only the nodes with an OLO are decoded, and their points
+    are taken from the decoded geometries in one call.
+
     """
-    output = []
+    if geometry_cache is not None:
+        layer = geometry_cache.layer(path)
+        rows = [i for i, item in enumerate(layer.properties)
+            if not item['OLO'] is None]
+        points = layer.geometries(rows)
+        coords = np.column_stack((shapely.get_x(points), shapely.get_y(points)))
+
+        return [
+            {
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': tuple(xy)},
+                'properties': {
+                    'OLO': layer.properties[i]['OLO'],
+                    'population': layer.properties[i]['population'],
+                }
+            }
+            for i, xy in zip(rows, coords.tolist())
+            ]
 
     with fiona.open(path, 'r') as source:
-        for item in source:
-            if not item['properties']['OLO'] is None:
-                output.append({
-                    'type': item['type'],
-                    'geometry': item['geometry'],
-                    'properties': {
-                        'OLO': item['properties']['OLO'],
-                        'population': item['properties']['population'],
-                    }
-                })
+        return select_existing_nodes(source)
+
+
+def select_existing_nodes(items):
+    """
+    Keep the OLO and population of each node which has an OLO.
+
+    """
+    output = []
+
+    for item in items:
+        if not item['properties']['OLO'] is None:
+            output.append({
+                'type': item['type'],
+                'geometry': item['geometry'],
+                'properties': {
+                    'OLO': item['properties']['OLO'],
+                    'population': item['properties']['population'],
+                }
+            })
 
     return output
 
@@ -233,47 +266,124 @@ def process_islands(exchanges, islands_lut):
 
 
 def design_network(nodes):
+    """
+    Link nodes with a minimum spanning tree of straight lines.
+
+    The tree is the Euclidean minimum spanning tree, taken from the
+    Delaunay triangulation of the nodes, so LineStrings are only built
+    for the n - 1 tree edges. Links are returned in ascending order of
+    length, and zero-length links between coincident nodes are dropped.
 
+    """
     links = []
 
-    edges = []
-    for node1_id, node1 in enumerate(nodes):
-        for node2_id, node2 in enumerate(nodes):
-            if node1_id != node2_id:
-                geom1 = Point(node1['geometry']['coordinates'])
-                geom2 = Point(node2['geometry']['coordinates'])
-                line = LineString([geom1, geom2])
-                edges.append({
-                    'type': 'Feature',
-                    'geometry': mapping(line),
-                    'properties':{
-                        'from': node1['properties']['OLO'],
-                        'to':  node2['properties']['OLO'],
-                        'length': line.length,
-                    }
-                })
+    coords = [node['geometry']['coordinates'][:2] for node in nodes]
+
+    for node1_id, node2_id, length in zip(*euclidean_mst(coords)):
+        if length > 0:
+            node1 = nodes[node1_id]
+            node2 = nodes[node2_id]
+            line = LineString([
+                Point(node2['geometry']['coordinates']),
+                Point(node1['geometry']['coordinates']),
+                ])
+            links.append({
+                'type': 'Feature',
+                'geometry': mapping(line),
+                'properties':{
+                    'from': node2['properties']['OLO'],
+                    'to':  node1['properties']['OLO'],
+                    'length': line.length,
+                }
+            })
+
+    return links
+
+
+# Links from each exchange flagged at a level to its k nearest nodes in
+# a tier: (flag, level, tier, k).
+TIER_LINKS = [
+    ('outer', 'core', 'outer', 4),
+    ('metro', 'metro', 'outer', 3),
+    ('tier_1', 'tier_1', 'metro', 3),
+    ('msan', 'msan', 'tier_1', 3),
+]
+
 
-    G = nx.Graph()
+def node_coords(nodes):
+    """
+    Return an (n x 2) array of node point coordinates.
+
+    """
+    return np.array(
+        [node['geometry']['coordinates'][:2] for node in nodes], dtype=float
+        ).reshape(-1, 2)
 
-    for node in nodes:
-        G.add_node(node['properties']['OLO'], object=node)
 
-    for edge in edges:
-        G.add_edge(edge['properties']['from'], edge['properties']['to'],
-            object=edge, weight=edge['properties']['length'])
+def link_tiers(exchanges, tiers):
+    """
+    Link exchanges to the nodes of each tier, with one k-nearest query
+    per tier.
 
-    tree = nx.minimum_spanning_edges(G)
+    `tiers` maps tier names (as in TIER_LINKS, plus 'inner') to node
+    lists. Returns a dict of flag to (exchange index, node index, length)
+    arrays, sorted by exchange and then distance. Exchanges flagged
+    'inner' are linked to every inner core node.
 
-    for branch in tree:
-        link = branch[2]['object']
-        if link['properties']['length'] > 0:
-            links.append(link)
+    """
+    coords = node_coords(exchanges)
+    links = {}
+
+    for flag, _, tier, k in [('inner', 'core', 'inner', len(tiers['inner']))] + \
+        TIER_LINKS:
+        rows = np.flatnonzero(
+            [int(exchange['properties'][flag]) > 0 for exchange in exchanges]
+            ).astype(np.intp)
+        origin_idx, node_idx, length = nearest_pairs(
+            coords[rows], node_coords(tiers[tier]), k
+            )
+        links[flag] = (rows[origin_idx], node_idx, length)
 
     return links
 
 
+def link_feature(exchange, source, sink, start, end, level):
+    """
+    Return a straight link from `start` to `end` as a GeoJSON feature,
+    carrying the tier flags and population of `exchange`.
+
+    """
+    return {
+        'type': exchange['type'],
+        'geometry': {
+            'type': 'LineString',
+            'coordinates': [
+                tuple(start['geometry']['coordinates'][:2]),
+                tuple(end['geometry']['coordinates'][:2]),
+                ]
+        },
+        'properties': {
+            'source': source['properties']['OLO'],
+            'sink': sink['properties']['OLO'],
+            'population': exchange['properties']['population'],
+            'level': level,
+            'inner': exchange['properties']['inner'],
+            'outer': exchange['properties']['outer'],
+            'metro': exchange['properties']['metro'],
+            'tier_1': exchange['properties']['tier_1'],
+            'msan': exchange['properties']['msan'],
+        }
+    }
+
+
 def connect(exchanges, islands, islands_lut):
     """
+    Link exchanges up through the core, metro, tier 1 and msan tiers,
+    and link each island to the mainland.
+
+    The links for every tier are found in one batched pass by
+    `link_tiers`, as index pairs, and converted to features exchange by
+    exchange.
 
     """
     output = []
@@ -287,8 +397,6 @@ def connect(exchanges, islands, islands_lut):
 
     for exchange in exchanges:
 
-        coords = shape(exchange['geometry'])
-
         if int(exchange['properties']['inner']) > 0:
             inner.append(exchange)
 
@@ -339,237 +447,74 @@ def connect(exchanges, islands, islands_lut):
 
     print(len(msan), len(tier_1), len(metro), len(outer), len(inner))
 
-    idx_inner_core = index.Index()
-    for exchange in inner:
-        coords = shape(exchange['geometry'])
-        idx_inner_core.insert(0, coords.bounds, exchange)
-
-    idx_all_core = index.Index()
-    for exchange in outer:
-        coords = shape(exchange['geometry'])
-        idx_all_core.insert(0, coords.bounds, exchange)
-
-    idx_metro = index.Index()
-    for exchange in metro:
-        coords = shape(exchange['geometry'])
-        idx_metro.insert(0, coords.bounds, exchange)
-
-    idx_tier_1 = index.Index()
-    for exchange in tier_1:
-        coords = shape(exchange['geometry'])
-        idx_tier_1.insert(0, coords.bounds, exchange)
-
-    idx_all = index.Index()
-    for exchange in exchanges:
-        coords = shape(exchange['geometry'])
-        idx_all.insert(0, coords.bounds, exchange)
+    tiers = {
+        'inner': inner,
+        'outer': outer,
+        'metro': metro,
+        'tier_1': tier_1,
+    }
 
     exchanges = metro + msan + tier_1
 
-    for exchange in exchanges:
-
-        geom = shape(exchange['geometry'])
-
-        if int(exchange['properties']['inner']) > 0:
-
-            closest_nodes =  list(
-                idx_inner_core.nearest(
-                    coords.bounds,
-                    len(inner)+1,
-                    objects='raw')
-                    )
-
-            for node_1 in closest_nodes:
-
-                coords_node_1 = shape(node_1['geometry'])
-
-                for node_2 in closest_nodes:
-
-                    coords_node_2 = shape(node_2['geometry'])
-
-                    output.append({
-                        'type': exchange['type'],
-                        'geometry': {
-                            'type': 'LineString',
-                            'coordinates': [
-                                list(coords_node_1.coords)[0],
-                                list(coords_node_2.coords)[0]]
-                        },
-                        'properties': {
-                            'source': node_1['properties']['OLO'],
-                            'sink': node_2['properties']['OLO'],
-                            'population': exchange['properties']['population'],
-                            'level': 'core',
-                            'inner': exchange['properties']['inner'],
-                            'outer': exchange['properties']['outer'],
-                            'metro': exchange['properties']['metro'],
-                            'tier_1': exchange['properties']['tier_1'],
-                            'msan': exchange['properties']['msan'],
-                        }
-                    })
-
-        if int(exchange['properties']['outer']) > 0:
-
-            closest_nodes =  list(
-                idx_all_core.nearest(
-                    coords.bounds,
-                    4, objects='raw')
-                    )
-
-            for node_1 in closest_nodes:
-
-                coords_node_1 = shape(node_1['geometry'])
-
-                output.append({
-                    'type': exchange['type'],
-                    'geometry': {
-                        'type': 'LineString',
-                        'coordinates': [
-                            list(geom.coords)[0],
-                            list(coords_node_1.coords)[0],
-                        ]
-                    },
-                    'properties': {
-                        'source': exchange['properties']['OLO'],
-                        'sink': node_1['properties']['OLO'],
-                        'population': exchange['properties']['population'],
-                        'level': 'core',
-                        'inner': exchange['properties']['inner'],
-                        'outer': exchange['properties']['outer'],
-                        'metro': exchange['properties']['metro'],
-                        'tier_1': exchange['properties']['tier_1'],
-                        'msan': exchange['properties']['msan'],
-                    }
-                })
-
-        if int(exchange['properties']['metro']) > 0:
-
-            closest_nodes =  list(
-                idx_all_core.nearest(
-                    geom.bounds,
-                    3, objects='raw')
-                    )
-
-            for node_1 in closest_nodes:
-
-                coords_node_1 = shape(node_1['geometry'])
-
-                output.append({
-                    'type': exchange['type'],
-                    'geometry': {
-                        'type': 'LineString',
-                        'coordinates': [
-                            list(geom.coords)[0],
-                            list(coords_node_1.coords)[0]]
-                    },
-                    'properties': {
-                        'source': exchange['properties']['OLO'],
-                        'sink': node_1['properties']['OLO'],
-                        'population': exchange['properties']['population'],
-                        'level': 'metro',
-                        'inner': exchange['properties']['inner'],
-                        'outer': exchange['properties']['outer'],
-                        'metro': exchange['properties']['metro'],
-                        'tier_1': exchange['properties']['tier_1'],
-                        'msan': exchange['properties']['msan'],
-                    }
-                })
-
-        if int(exchange['properties']['tier_1']) > 0:
-
-            closest_nodes =  list(
-                idx_metro.nearest(
-                    geom.bounds,
-                    3, objects='raw')
-                    )
-
-            for node_1 in closest_nodes:
-
-                coords_node_1 = shape(node_1['geometry'])
-
-                output.append({
-                    'type': exchange['type'],
-                    'geometry': {
-                        'type': 'LineString',
-                        'coordinates': [
-                            list(geom.coords)[0],
-                            list(coords_node_1.coords)[0]]
-                    },
-                    'properties': {
-                        'source': exchange['properties']['OLO'],
-                        'sink': node_1['properties']['OLO'],
-                        'population': exchange['properties']['population'],
-                        'level': 'tier_1',
-                        'inner': exchange['properties']['inner'],
-                        'outer': exchange['properties']['outer'],
-                        'metro': exchange['properties']['metro'],
-                        'tier_1': exchange['properties']['tier_1'],
-                        'msan': exchange['properties']['msan'],
-                    }
-                })
-
-        if int(exchange['properties']['msan']) > 0:
-
-            closest_nodes =  list(
-                idx_tier_1.nearest(
-                    geom.bounds,
-                    3, objects='raw')
-                    )
-
-            for node in closest_nodes:
-
-                coords_nearest = shape(node['geometry'])
-
-                output.append({
-                    'type': exchange['type'],
-                    'geometry': {
-                        'type': 'LineString',
-                        'coordinates': [
-                            list(coords_nearest.coords)[0],
-                            list(geom.coords)[0]]
-                    },
-                    'properties': {
-                        'source': exchange['properties']['OLO'],
-                        'sink': node['properties']['OLO'],
-                        'population': exchange['properties']['population'],
-                        'level': 'msan',
-                        'inner': exchange['properties']['inner'],
-                        'outer': exchange['properties']['outer'],
-                        'metro': exchange['properties']['metro'],
-                        'tier_1': exchange['properties']['tier_1'],
-                        'msan': exchange['properties']['msan'],
-                    }
-                })
+    links = link_tiers(exchanges, tiers)
+
+    # Where each exchange's links start in each flag's arrays.
+    starts = dict(
+        (flag, np.searchsorted(exchange_idx, np.arange(len(exchanges) + 1)))
+        for flag, (exchange_idx, _, _) in links.items()
+        )
+
+    for row, exchange in enumerate(exchanges):
+
+        # Inner exchanges link every pair of inner core nodes.
+        start, end = starts['inner'][row:row + 2]
+        closest_nodes = [inner[i] for i in links['inner'][1][start:end]]
+        for node_1 in closest_nodes:
+            for node_2 in closest_nodes:
+                output.append(link_feature(
+                    exchange, node_1, node_2, node_1, node_2, 'core'
+                    ))
+
+        for flag, level, tier, _ in TIER_LINKS:
+            start, end = starts[flag][row:row + 2]
+            for i in links[flag][1][start:end]:
+                node = tiers[tier][i]
+                if flag == 'msan':
+                    output.append(link_feature(
+                        exchange, exchange, node, node, exchange, level
+                        ))
+                else:
+                    output.append(link_feature(
+                        exchange, exchange, node, exchange, node, level
+                        ))
 
     island_names = set()
     for exchange in islands_lut:
         island_names.add(exchange['island'])
 
+    # Link every island exchange to its nearest tier 1 node at once.
+    _, mainland_idx, mainland_length = nearest_pairs(
+        node_coords(islands), node_coords(tier_1), 1
+        )
+
     island_edges = []
 
     for island_name in list(island_names):
         node_lut = []
-        for exchange in islands:
+        for exchange, closest, length in zip(
+            islands, mainland_idx, mainland_length):
             if exchange['properties']['island'] == island_name:
-                geom1 = shape(exchange['geometry'])
-
-                closest_node =  list(
-                    idx_tier_1.nearest(
-                        geom1.bounds,
-                        1, objects='raw')
-                        )[0]
+                closest_node = tier_1[closest]
 
+                geom1 = shape(exchange['geometry'])
                 geom2 = shape(closest_node['geometry'])
 
-                line = LineString([geom1, geom2])
-
                 node_lut.append({
                     'OLO_island': exchange['properties']['OLO'],
-                    'OLO_island_geom': mapping(geom1),
+                    'OLO_island_geom': geom1,
                     'OLO_mainland': closest_node['properties']['OLO'],
-                    'OLO_mainland_geom': mapping(geom2),
-                    'line': mapping(line),
-                    'length': line.length,
+                    'OLO_mainland_geom': geom2,
+                    'length': length,
                     'population': exchange['properties']['OLO'],
                     'inner': exchange['properties']['inner'],
                     'outer': exchange['properties']['outer'],
@@ -582,7 +527,9 @@ def connect(exchanges, islands, islands_lut):
 
         island_edges.append({
             'type': 'Feature',
-            'geometry': ranked['line'],
+            'geometry': mapping(
+                LineString([ranked['OLO_island_geom'], ranked['OLO_mainland_geom']])
+                ),
             'properties': {
                 'source': ranked['OLO_island'],
                 'sink': ranked['OLO_mainland'],
@@ -634,7 +581,8 @@ def write_shapefile(data, directory, filename, crs):
 if __name__ == '__main__':
 
     path = os.path.join(BASE_PATH, 'telecoms_nodes.shp')
-    exchanges = read_existing_nodes(path)#[:10]
+    geometry_cache = GeometryCache(os.path.join(CACHE_PATH, 'geometry'))
+    exchanges = read_existing_nodes(path, geometry_cache)#[:10]
     print('total number of exchanges: {}'.format(len(exchanges)))
 
     path = os.path.join(BASE_PATH, 'core_bt_21cn.csv')
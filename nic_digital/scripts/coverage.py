@@ -0,0 +1,188 @@
+"""
+Ofcom Connected Nations coverage table.
+
+Written by Ed Oughton
+
+"""
+import os
+import csv
+
+import numpy as np
+
+
+class CoverageTable(object):
+    """
+    Coverage data for every lad, parsed once and keyed by lad id.
+
+    Every column other than the lad id and name is held as a float in a
+    single (lads x columns) array, so any coverage column, such as
+    '4G_geo_out_4', can be selected without rereading the CSV.
+
+    """
+    ID_COLUMN = 'laua'
+    NAME_COLUMN = 'laua_name'
+
+    def __init__(self, lad_ids, lad_names, columns, values):
+        self.lad_ids = np.asarray(lad_ids, dtype=str)
+        self.lad_names = np.asarray(lad_names, dtype=str)
+        self.columns = [str(column) for column in columns]
+        self.values = np.asarray(values, dtype=float).reshape(
+            len(self.lad_ids), len(self.columns)
+            )
+        self.row_index = dict(
+            (lad_id, i) for i, lad_id in enumerate(self.lad_ids.tolist())
+            )
+
+
+    def __len__(self):
+        return len(self.lad_ids)
+
+
+    def __contains__(self, lad_id):
+        return lad_id in self.row_index
+
+
+    @classmethod
+    def load(cls, path, use_cache=True):
+        """
+        Load the coverage CSV at `path`.
+
+        When `use_cache` is set, the parsed table is kept in a binary
+        `.npz` sidecar next to the CSV and reused until the CSV's size or
+        modification time changes.
+
+        """
+        cache_path = path + '.npz'
+        stat = os.stat(path)
+        fingerprint = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+        if use_cache and os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                if np.array_equal(cached['fingerprint'], fingerprint):
+                    return cls(
+                        cached['lad_ids'], cached['lad_names'],
+                        cached['columns'], cached['values']
+                        )
+
+        table = cls.read_csv(path)
+
+        if use_cache:
+            table.save(cache_path, fingerprint)
+
+        return table
+
+
+    @classmethod
+    def read_csv(cls, path):
+        """
+        Parse the coverage CSV. Blank or non-numeric cells become NaN.
+
+        """
+        lad_ids = []
+        lad_names = []
+        values = []
+
+        with open(path, 'r') as source:
+            reader = csv.DictReader(source)
+            columns = [
+                name for name in reader.fieldnames
+                if name not in (cls.ID_COLUMN, cls.NAME_COLUMN)
+                ]
+            for line in reader:
+                lad_ids.append(line[cls.ID_COLUMN])
+                lad_names.append(line[cls.NAME_COLUMN])
+                values.append([to_float(line[name]) for name in columns])
+
+        return cls(lad_ids, lad_names, columns, values)
+
+
+    def save(self, path, fingerprint):
+        """
+        Write the table to an `.npz` file, replacing any existing one.
+
+        """
+        temp_path = path + '.tmp'
+
+        try:
+            with open(temp_path, 'wb') as sink:
+                np.savez(
+                    sink,
+                    fingerprint=fingerprint,
+                    lad_ids=self.lad_ids,
+                    lad_names=self.lad_names,
+                    columns=np.asarray(self.columns, dtype=str),
+                    values=self.values,
+                    )
+            os.replace(temp_path, path)
+        except OSError as error:
+            print('- Could not write coverage cache {}: {}'.format(path, error))
+
+
+    def column(self, name):
+        """
+        Return a coverage column as an array aligned with `lad_ids`.
+
+        """
+        return self.values[:, self.columns.index(name)]
+
+
+    def get(self, lad_id, name):
+        """
+        Return one coverage value for a lad, or None if the lad is unknown.
+
+        """
+        if lad_id not in self.row_index:
+            return None
+
+        return self.values[self.row_index[lad_id], self.columns.index(name)]
+
+
+    def lookup(self, lad_ids, names):
+        """
+        Return a (len(lad_ids) x len(names)) array of coverage values.
+
+        Unknown lads are NaN.
+
+        """
+        columns = [self.columns.index(name) for name in names]
+        output = np.full((len(lad_ids), len(columns)), np.nan)
+
+        for i, lad_id in enumerate(lad_ids):
+            row = self.row_index.get(lad_id)
+            if row is not None:
+                output[i] = self.values[row, columns]
+
+        return output
+
+
+    def row(self, lad_id, prefix='4G_geo_out_'):
+        """
+        Return a lad's coverage as a dict, keeping columns starting with
+        `prefix`, or None if the lad is unknown.
+
+        """
+        if lad_id not in self.row_index:
+            return None
+
+        i = self.row_index[lad_id]
+
+        output = {
+            'lad_id': lad_id,
+            'lad_name': str(self.lad_names[i]),
+        }
+        for j, name in enumerate(self.columns):
+            if name.startswith(prefix):
+                output[name] = self.values[i, j]
+
+        return output
+
+
+def to_float(value):
+    """
+    Convert a CSV cell to float, returning NaN if it is not numeric.
+
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
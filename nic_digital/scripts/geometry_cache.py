@@ -0,0 +1,269 @@
+"""
+Persistent, memory-mapped WKB cache of shapefile layers, with an
+on-disk R-tree index of each layer's bounds.
+
+Written by Ed Oughton
+
+"""
+import os
+import json
+import hashlib
+
+import fiona
+import numpy as np
+import shapely
+from rtree import index
+from shapely.geometry import box, mapping, shape
+
+from spatial import pack_wkb, unpack_wkb
+
+
+class GeometryCache(object):
+    """
+    Directory of cached layers. Each source file is stored once as a
+    WKB blob, an offsets index, a bounds array and its properties, keyed
+    by the path, size and modification time of the file and its sidecar
+    files (.dbf, .shx, .prj, .cpg). An R-tree of the bounds is added
+    under the same key the first time it is queried.
+
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+
+    def layer(self, path):
+        """
+        Return the GeometryLayer for `path`, building it on first use or
+        when the source file has changed.
+
+        """
+        prefix = os.path.join(self.directory, layer_key(path))
+
+        if not os.path.exists(prefix + '.json'):
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            write_layer(path, prefix)
+
+        return GeometryLayer(prefix)
+
+
+class GeometryLayer(object):
+    """
+    A cached layer. The WKB blob is memory-mapped, so geometries are
+    only decoded when requested by index.
+
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._index = None
+        self.blob = np.load(prefix + '.wkb.npy', mmap_mode='r')
+        self.offsets = np.load(prefix + '.offsets.npy')
+        self.bounds = np.load(prefix + '.bounds.npy')
+
+        with open(prefix + '.json', 'r') as source:
+            meta = json.load(source)
+
+        self.source = meta['source']
+        self.properties = meta['properties']
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+    def geometries(self, indices=None):
+        """
+        Return shapely geometries for all features, or those at `indices`.
+
+        """
+        return unpack_wkb(self.blob, self.offsets, indices)
+
+
+    def features(self, indices=None):
+        """
+        Yield features (all, or those at `indices`) as GeoJSON dicts.
+
+        """
+        if indices is None:
+            indices = range(len(self))
+
+        indices = list(indices)
+
+        for i, geometry in zip(indices, self.geometries(indices)):
+            yield {
+                'type': 'Feature',
+                'geometry': mapping(geometry),
+                'properties': self.properties[i],
+            }
+
+
+    def spatial_index(self):
+        """
+        Return an R-tree of the layer's feature bounds, keyed by row.
+
+        The tree is STR bulk-loaded from the bounds array and stored
+        next to the layer on first use, then reopened from disk.
+
+        """
+        if self._index is None:
+            if not os.path.exists(self.prefix + '.rtree.idx'):
+                write_index(self.prefix + '.rtree', self.bounds)
+            self._index = index.Index(self.prefix + '.rtree')
+
+        return self._index
+
+
+    def select(self, bbox=None, mask=None):
+        """
+        Return the indices of features whose geometry intersects the
+        (minx, miny, maxx, maxy) `bbox` and the shapely geometry `mask`,
+        as fiona's `filter` does.
+
+        Candidates come from the layer's R-tree, queried with `bbox` and
+        with the bounds of each part of `mask`, so only features near
+        them are decoded for the final intersects tests.
+
+        """
+        if len(self) == 0:
+            return np.array([], dtype=np.intp)
+
+        tree = self.spatial_index()
+        rows = np.arange(len(self))
+
+        if bbox is not None:
+            rows = query_rows(tree, [bbox])
+
+            if len(rows) > 0:
+                rows = rows[shapely.intersects(box(*bbox), self.geometries(rows))]
+
+        if mask is not None:
+            parts = shapely.get_parts(mask)
+            parts = parts[~shapely.is_empty(parts)]
+            rows = np.intersect1d(
+                rows, query_rows(tree, shapely.bounds(parts).reshape(-1, 4))
+                )
+
+            if len(rows) > 0:
+                shapely.prepare(mask)
+                rows = rows[shapely.intersects(mask, self.geometries(rows))]
+
+        return rows
+
+
+def query_rows(tree, boxes):
+    """
+    Return the sorted, unique rows whose bounds intersect any of `boxes`.
+
+    """
+    rows = set()
+    for bounds in boxes:
+        rows.update(tree.intersection(tuple(bounds)))
+
+    return np.array(sorted(rows), dtype=np.intp)
+
+
+def write_index(basename, bounds):
+    """
+    STR bulk-load an R-tree of `bounds` rows into `basename`.idx/.dat.
+    The index file is moved into place last, so a partly written tree
+    is rebuilt.
+
+    """
+    properties = index.Property()
+    properties.overwrite = True
+
+    tree = index.Index(
+        basename + '.tmp',
+        (
+            (row, tuple(row_bounds), None)
+            for row, row_bounds in enumerate(bounds.tolist())
+        ),
+        properties=properties,
+        )
+    tree.close()
+
+    os.replace(basename + '.tmp.dat', basename + '.dat')
+    os.replace(basename + '.tmp.idx', basename + '.idx')
+
+
+# Files stored alongside a shapefile's .shp, holding its attributes,
+# record offsets, projection and encoding.
+SIDECAR_EXTENSIONS = ('.dbf', '.shx', '.prj', '.cpg')
+
+
+def source_files(path):
+    """
+    Return `path` and every sidecar file of it which exists, so that a
+    shapefile is keyed by its attributes as well as its geometry.
+
+    """
+    base, extension = os.path.splitext(path)
+    paths = [path]
+
+    if extension.lower() == '.shp':
+        for sidecar in SIDECAR_EXTENSIONS:
+            for candidate in (base + sidecar, base + sidecar.upper()):
+                if os.path.isfile(candidate) and candidate not in paths:
+                    paths.append(candidate)
+
+    return paths
+
+
+def file_signature(path):
+    """
+    Return a string of the absolute path, size and modification time of
+    `path` and of each of its sidecar files.
+
+    """
+    signature = []
+    for source in source_files(path):
+        stat = os.stat(source)
+        signature.append('{}:{}:{}'.format(
+            os.path.abspath(source), stat.st_size, stat.st_mtime_ns
+            ))
+
+    return '|'.join(signature)
+
+
+def layer_key(path):
+    """
+    Key a source file by the path, size and modification time of it and
+    its sidecar files.
+
+    """
+    key = file_signature(path)
+
+    return '{}-{}'.format(
+        os.path.splitext(os.path.basename(path))[0],
+        hashlib.sha256(key.encode()).hexdigest()[:20]
+        )
+
+
+def write_layer(path, prefix):
+    """
+    Read a layer through fiona once and write its cache files. The
+    metadata file is written last, so a partly written layer is rebuilt.
+
+    """
+    geometries = []
+    properties = []
+
+    with fiona.open(path, 'r') as source:
+        for feature in source:
+            geometries.append(shape(feature['geometry']))
+            properties.append(dict(feature['properties']))
+
+    geometries = np.array(geometries, dtype=object)
+    blob, offsets = pack_wkb(geometries)
+    bounds = shapely.bounds(geometries).reshape(-1, 4)
+
+    for name, array in (('wkb', blob), ('offsets', offsets), ('bounds', bounds)):
+        with open('{}.{}.npy.tmp'.format(prefix, name), 'wb') as sink:
+            np.save(sink, array)
+        os.replace(
+            '{}.{}.npy.tmp'.format(prefix, name), '{}.{}.npy'.format(prefix, name)
+            )
+
+    with open(prefix + '.json.tmp', 'w') as sink:
+        json.dump({'source': os.path.abspath(path), 'properties': properties}, sink)
+    os.replace(prefix + '.json.tmp', prefix + '.json')
@@ -5,16 +5,43 @@ import csv
 import fiona
 import time
 
-from shapely.geometry import shape, Point, LineString, mapping
-from shapely.ops import  cascaded_union
+import numpy as np
+import shapely
+from scipy.spatial import cKDTree
 
-from rtree import index
+from shapely.geometry import box, shape, mapping
 
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+
+from checkpoint import StageCache
+from coverage import CoverageTable
+from geometry_cache import GeometryCache
+from profiling import StageProfiler
+from sectors import GroupBy, Lads, PostcodeSectors, index_join, normalise_id
+from sites import Links, Sites, read_sitefinder
+from spatial import (PolygonIndex, areas, centroids, cluster_points,
+    dissolved_centroids, points_in_polygons, polygon_overlay, polygon_point_pairs)
 
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
 BASE_PATH = CONFIG['file_locations']['base_path']
+CACHE_PATH = CONFIG.get('file_locations', 'cache_path', fallback='cache')
+WORKERS = CONFIG.getint('processing', 'workers', fallback=1)
+LAD_OVERLAY = CONFIG.getboolean('processing', 'lad_overlay', fallback=False)
+OPERATORS = [
+    operator.strip() for operator in
+    CONFIG.get('processing', 'operators', fallback='O2, Vodafone').split(',')
+    if operator.strip()
+    ]
+PER_OPERATOR = CONFIG.getboolean('processing', 'per_operator', fallback=False)
+BACKHAUL_AREAS = CONFIG.getboolean('processing', 'backhaul_areas', fallback=False)
+PROFILE_STAGES = [
+    stage.strip() for stage in
+    CONFIG.get('processing', 'profile_stages', fallback='').split(',')
+    if stage.strip()
+    ]
 
 #####################################
 # setup file locations and data files
@@ -23,36 +50,54 @@ BASE_PATH = CONFIG['file_locations']['base_path']
 DATA_RAW = os.path.join(BASE_PATH, 'raw')
 DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
 
+COVERAGE_SCENARIOS = ['4G_geo_out_{}'.format(i) for i in range(5)]
+
 #####################################
 # READ MAIN DATA
 #####################################
 
-def read_lads():
+# LADs left out of the model, matched by id prefix.
+EXCLUDED_LADS = (
+    'E06000053',
+    'S12000027',
+    'N09000001',
+    'N09000002',
+    'N09000003',
+    'N09000004',
+    'N09000005',
+    'N09000006',
+    'N09000007',
+    'N09000008',
+    'N09000009',
+    'N09000010',
+    'N09000011',
+    )
+
+
+def read_lads(geometry_cache=None):
     """
-    Read in all lad shapes.
+    Read in all lad shapes, as a Lads table of names and shapely
+    geometries.
+
+    With a GeometryCache, the shapes are read from its cached copy of
+    the shapefile, and only the geometries of the lads kept are decoded.
 
     """
     lad_shapes = os.path.join(
         DATA_RAW, 'shapes', 'lad_uk_2016-12.shp'
         )
 
+    if geometry_cache is not None:
+        layer = geometry_cache.layer(lad_shapes)
+        rows = [i for i, item in enumerate(layer.properties) if
+            not item['name'].startswith(EXCLUDED_LADS)]
+        return Lads(
+            [layer.properties[i]['name'] for i in rows], layer.geometries(rows)
+            )
+
     with fiona.open(lad_shapes, 'r') as lad_shape:
-        return [lad for lad in lad_shape if
-        not lad['properties']['name'].startswith((
-            'E06000053',
-            'S12000027',
-            'N09000001',
-            'N09000002',
-            'N09000003',
-            'N09000004',
-            'N09000005',
-            'N09000006',
-            'N09000007',
-            'N09000008',
-            'N09000009',
-            'N09000010',
-            'N09000011',
-            ))]
+        return Lads.from_features(lad for lad in lad_shape if
+        not lad['properties']['name'].startswith(EXCLUDED_LADS))
 
 
 def lad_lut(lads):
@@ -60,83 +105,164 @@ def lad_lut(lads):
     Yield lad IDs for use as a lookup.
 
     """
-    for lad in lads:
-        yield lad['properties']['name']
+    if isinstance(lads, Lads):
+        names = lads.name
+    else:
+        names = (lad['properties']['name'] for lad in lads)
+
+    for name in names:
+        yield name
 
 
-def read_postcode_sectors(path):
+def read_postcode_sectors(path, bbox=None, lads=None, geometry_cache=None):
     """
-    Read all postcode sector shapes.
+    Read postcode sector shapes into a PostcodeSectors table.
+
+    Pass a (minx, miny, maxx, maxy) `bbox`, a Lads table, or both,
+    to read only the sectors which intersect them. With both, sectors
+    must intersect the part of the lads inside `bbox`. The filter is
+    applied by fiona before features are returned, and shapely
+    geometries are only built for the sectors which pass it.
+
+    With a GeometryCache, sectors are read from its cached copy of the
+    shapefile, filtered by their stored bounds before any geometry is
+    decoded.
 
     """
+    ids = []
+    geometries = []
+
+    mask = None
+    if lads is not None:
+        if not isinstance(lads, Lads):
+            lads = Lads.from_features(lads)
+
+        mask = shapely.union_all(lads.geometry)
+
+        # fiona cannot filter by a bbox and a mask together, so clip the
+        # mask to the bbox instead.
+        if bbox is not None:
+            mask = shapely.intersection(mask, box(*bbox))
+            bbox = None
+
+    if geometry_cache is not None:
+        layer = geometry_cache.layer(path)
+        rows = layer.select(bbox=bbox, mask=mask)
+        return PostcodeSectors(
+            [layer.properties[i]['RMSect'] for i in rows], layer.geometries(rows)
+            )
+
+    if mask is not None:
+        mask = mapping(mask)
+
     with fiona.open(path, 'r') as pcd_sector_shapes:
-        return [pcd for pcd in pcd_sector_shapes]
+        if bbox is None and mask is None:
+            features = iter(pcd_sector_shapes)
+        else:
+            features = pcd_sector_shapes.filter(bbox=bbox, mask=mask)
+
+        for pcd in features:
+            ids.append(pcd['properties']['RMSect'])
+            geometries.append(shape(pcd['geometry']))
+
+    return PostcodeSectors(ids, geometries)
 
 
-def add_lad_to_postcode_sector(postcode_sectors, lads):
+def add_lad_to_postcode_sector(postcode_sectors, lads, workers=1):
     """
     Add the LAD indicator(s) to the relevant postcode sector.
 
+    Each sector goes to the LAD containing its centroid, and sectors
+    whose centroid falls outside every LAD are dropped. LAD shapes are
+    prepared once, and centroids and areas are computed in bulk. With
+    `workers` > 1 the join runs in a process pool. Area is returned in
+    km^2.
+
     """
-    final_postcode_sectors = []
+    if not isinstance(lads, Lads):
+        lads = Lads.from_features(lads)
 
-    idx = index.Index(
-        (i, shape(lad['geometry']).bounds, lad)
-        for i, lad in enumerate(lads)
-    )
+    lad_index = points_in_polygons(
+        centroids(postcode_sectors.geometry), lads.geometry, workers=workers
+        )
+
+    matched = np.flatnonzero(lad_index >= 0)
+    output = postcode_sectors.take(matched)
+
+    return output.assign(
+        lad=lads.name[lad_index[matched]],
+        area=areas(output.geometry) / 1e6,
+        )
+
+
+def overlay_lads_on_postcode_sectors(postcode_sectors, lads):
+    """
+    Split each postcode sector by the LADs it overlaps, returning one
+    row per sector and LAD, holding the part of the sector in that LAD.
+
+    `fraction` is the share of the sector's area in each LAD, and is
+    used by `calculate_lad_population` to split the sector population,
+    so sectors on a LAD boundary count towards every LAD they cover.
+    Area is returned in km^2. Sectors outside every LAD are dropped.
+
+    """
+    if not isinstance(lads, Lads):
+        lads = Lads.from_features(lads)
 
-    for postcode_sector in postcode_sectors:
-        for n in idx.intersection(
-            (shape(postcode_sector['geometry']).bounds), objects=True):
-            postcode_sector_centroid = shape(postcode_sector['geometry']).centroid
-            postcode_sector_shape = shape(postcode_sector['geometry'])
-            lad_shape = shape(n.object['geometry'])
-            if postcode_sector_centroid.intersects(lad_shape):
-                final_postcode_sectors.append({
-                    'type': postcode_sector['type'],
-                    'geometry': postcode_sector['geometry'],
-                    'properties':{
-                        'id': postcode_sector['properties']['RMSect'],
-                        'lad': n.object['properties']['name'],
-                        'area': postcode_sector_shape.area,
-                        },
-                    })
-                break
+    sector_idx, lad_idx, pieces = polygon_overlay(
+        postcode_sectors.geometry, lads.geometry
+        )
+
+    piece_area = areas(pieces)
 
-    return final_postcode_sectors
+    output = postcode_sectors.take(sector_idx)
+
+    return PostcodeSectors(
+        output.id,
+        pieces,
+        lad=lads.name[lad_idx],
+        area=piece_area / 1e6,
+        fraction=piece_area / areas(output.geometry),
+        )
 
 
-def load_coverage_data(lad_id):
+def read_coverage_table(use_cache=True):
     """
-    Import Ofcom Connected Nations coverage data (2018).
+    Import Ofcom Connected Nations coverage data (2018) for all lads.
+
+    The CSV is parsed once and cached in a binary sidecar, which is
+    rebuilt whenever the CSV changes.
 
     """
     path = os.path.join(
         DATA_RAW, 'ofcom_2018', '201809_mobile_laua_r02.csv'
         )
 
-    with open(path, 'r') as source:
-        reader = csv.DictReader(source)
-        for line in reader:
-            if line['laua'] == lad_id:
-                return {
-                    'lad_id': line['laua'],
-                    'lad_name': line['laua_name'],
-                    '4G_geo_out_0': line['4G_geo_out_0'],
-                    '4G_geo_out_1': line['4G_geo_out_1'],
-                    '4G_geo_out_2': line['4G_geo_out_2'],
-                    '4G_geo_out_3': line['4G_geo_out_3'],
-                    '4G_geo_out_4': line['4G_geo_out_4'],
-                }
+    return CoverageTable.load(path, use_cache=use_cache)
+
+
+def load_coverage_data(lad_id, coverage=None):
+    """
+    Import Ofcom Connected Nations coverage data (2018) for one lad.
+
+    Pass a CoverageTable as `coverage` when looking up several lads.
 
-def load_in_weights():
+    """
+    if coverage is None:
+        coverage = read_coverage_table()
+
+    return coverage.row(lad_id)
+
+
+def load_in_weights(path=None):
     """
     Load in postcode sector weights.
 
     """
-    path = os.path.join(
-        DATA_RAW, 'pcd_sector_weights', 'population_weights.csv'
-        )
+    if path is None:
+        path = os.path.join(
+            DATA_RAW, 'pcd_sector_weights', 'population_weights.csv'
+            )
 
     population_data = []
 
@@ -151,166 +277,252 @@ def load_in_weights():
     return population_data
 
 
-def add_weights_to_postcode_sector(postcode_sectors, weights):
+def add_weights_to_postcode_sector(postcode_sectors, weights,
+    return_unmatched=False):
     """
-    Add weights to postcode sector
+    Add weights to postcode sector.
+
+    Ids are normalised once on each side and joined through a hash
+    index. Postcode sectors without a weight are dropped and weights
+    without a postcode sector are ignored; both are counted in a printed
+    summary, and returned as id lists when `return_unmatched` is set.
 
     """
-    output = []
+    pcd_ids = [normalise_id(pcd_id) for pcd_id in postcode_sectors.id]
+    weight_ids = [normalise_id(weight['id']) for weight in weights]
 
-    for postcode_sector in postcode_sectors:
-        pcd_id = postcode_sector['properties']['id'].replace(' ', '')
-        for weight in weights:
-            weight_id = weight['id'].replace(' ', '')
-            if pcd_id == weight_id:
-                output.append({
-                    'type': postcode_sector['type'],
-                    'geometry': postcode_sector['geometry'],
-                    'properties': {
-                        'id': pcd_id,
-                        'lad': postcode_sector['properties']['lad'],
-                        'population_weight': weight['population'],
-                        'area_km2': (postcode_sector['properties']['area'] / 1e6),
-                    }
-                })
+    pcd_rows, weight_rows, unmatched_pcds, unmatched_weights = index_join(
+        pcd_ids, weight_ids
+        )
+
+    if len(unmatched_pcds) > 0 or len(unmatched_weights) > 0:
+        print('- {} postcode sectors without a weight, {} weights without a '
+            'postcode sector'.format(len(unmatched_pcds), len(unmatched_weights)))
 
+    output = postcode_sectors.take(pcd_rows).assign(
+        id=[pcd_ids[i] for i in pcd_rows],
+        population=[weights[j]['population'] for j in weight_rows],
+        )
+
+    if return_unmatched:
+        return (
+            output,
+            [pcd_ids[i] for i in unmatched_pcds],
+            [weight_ids[j] for j in unmatched_weights],
+            )
 
     return output
 
 
 def calculate_lad_population(postcode_sectors):
     """
+    Add each postcode sector's share of its lad population, and the
+    resulting population density.
+
+    For sectors split by `overlay_lads_on_postcode_sectors`, each part
+    holds its `fraction` of the sector population.
 
     """
-    lad_ids = set()
+    population = postcode_sectors.population
+    if postcode_sectors.fraction is not None:
+        population = population * postcode_sectors.fraction
 
-    for pcd_sector in postcode_sectors:
-        lad_ids.add(pcd_sector['properties']['lad'])
+    lads = postcode_sectors.group_by('lad')
 
-    lad_population = []
+    totals = lads.broadcast(lads.sum(population))
 
-    for lad_id in lad_ids:
-        population = 0
-        for pcd_sector in postcode_sectors:
-            if pcd_sector['properties']['lad'] == lad_id:
-                population += pcd_sector['properties']['population_weight']
-        lad_population.append({
-            'lad': lad_id,
-            'population': population,
-        })
+    weight = lads.share(population)
 
-    output = []
+    return postcode_sectors.assign(
+        population=totals * weight,
+        weight=weight,
+        density=weight / (postcode_sectors.area / 1e6),
+        )
 
-    for pcd_sector in postcode_sectors:
-        for lad in lad_population:
-            if pcd_sector['properties']['lad'] == lad['lad']:
 
-                weight = (
-                    pcd_sector['properties']['population_weight'] /
-                    lad['population']
-                )
+def disaggregate(forecast, postcode_sectors):
+    """
+    Disaggregate a lad population forecast to postcode sectors.
 
-                output.append({
-                    'type': pcd_sector['type'],
-                    'geometry': pcd_sector['geometry'],
-                    'properties': {
-                        'id': pcd_sector['properties']['id'],
-                        'lad': pcd_sector['properties']['lad'],
-                        'population': lad['population'] * weight,
-                        'weight': weight,
-                        'area_km2': pcd_sector['properties']['area_km2'],
-                        'pop_density_km2': (
-                            weight /
-                            (pcd_sector['properties']['area_km2'] / 1e6)
-                            ),
-                    },
-                })
+    Returns one dict per year, lad and postcode sector. Use
+    `write_disaggregated` to stream large forecasts straight to disk.
+
+    """
+    output = []
+
+    for year, lad_ids, pcd_ids, population in disaggregate_by_year(
+        forecast, postcode_sectors):
+        for lad_id, pcd_id, pcd_population in zip(lad_ids, pcd_ids, population):
+            output.append({
+                'year': year,
+                'lad': lad_id,
+                'id': pcd_id,
+                'population': int(pcd_population),
+            })
 
     return output
 
 
-def disaggregate(forecast, postcode_sectors):
+def disaggregate_by_year(forecast, postcode_sectors):
     """
+    Yield (year, lad ids, postcode sector ids, population) arrays, one
+    forecast year at a time.
+
+    Sectors are grouped by lad once. Each year's lad populations are
+    then repeated over their sectors and multiplied by the sector weight
+    array in one step, so only a single year is ever held in memory.
+    Forecast rows for a year are expected to be consecutive.
 
     """
-    output = []
+    lads = postcode_sectors.group_by('lad')
+    lad_sectors = lads.indices()
+    no_sectors = np.array([], dtype=np.intp)
 
-    seen_lads = set()
-
-    for line in forecast:
-        forecast_lad_id = line['lad']
-        for postcode_sector in postcode_sectors:
-            pcd_sector_lad_id = postcode_sector['properties']['lad']
-            if forecast_lad_id == pcd_sector_lad_id:
-                # print(postcode_sector)
-                seen_lads.add(line['lad'])
-                seen_lads.add(postcode_sector['properties']['lad'])
-                output.append({
-                    'year': line['year'],
-                    'lad': line['lad'],
-                    'id': postcode_sector['properties']['id'],
-                    'population': int(
-                        float(line['population']) *
-                        float(postcode_sector['properties']['weight'])
-                        )
-                })
+    for year, lines in groupby(forecast, key=lambda line: line['year']):
 
-    return output
+        lines = list(lines)
 
+        sectors = [lad_sectors.get(line['lad'], no_sectors) for line in lines]
+        counts = [len(rows) for rows in sectors]
+        rows = np.concatenate(sectors) if sectors else no_sectors
 
-def allocate_4G_coverage(postcode_sectors, lad_lut):
+        lad_population = np.repeat(
+            [float(line['population']) for line in lines], counts
+            )
 
-    output = []
+        population = np.trunc(
+            lad_population * postcode_sectors.weight[rows]
+            ).astype(np.int64)
 
-    for lad_id in lad_lut:
+        yield (
+            year,
+            np.repeat(np.array([line['lad'] for line in lines], dtype=object), counts),
+            postcode_sectors.id[rows],
+            population,
+            )
 
-        sectors_in_lad = get_postcode_sectors_in_lad(postcode_sectors, lad_id)
 
-        total_area = sum([s['properties']['area_km2'] for s in \
-            get_postcode_sectors_in_lad(postcode_sectors, lad_id)])
+def write_disaggregated(forecast, postcode_sectors, directory, filename):
+    """
+    Stream a disaggregated forecast to CSV, or to Parquet if `filename`
+    ends in '.parquet' (requires pyarrow), writing one year at a time.
 
-        coverage_data = load_coverage_data(lad_id)
+    Returns the number of rows written.
 
-        coverage_amount = float(coverage_data['4G_geo_out_4'])
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
 
-        covered_area = total_area * (coverage_amount/100)
+    path = os.path.join(directory, filename)
+    chunks = disaggregate_by_year(forecast, postcode_sectors)
+    rows_written = 0
+
+    if filename.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([
+            ('year', pa.string()),
+            ('lad', pa.string()),
+            ('id', pa.string()),
+            ('population', pa.int64()),
+        ])
+
+        with pq.ParquetWriter(path, schema) as writer:
+            for year, lad_ids, pcd_ids, population in chunks:
+                writer.write_table(pa.Table.from_arrays([
+                    pa.array([str(year)] * len(pcd_ids)),
+                    pa.array(list(lad_ids)),
+                    pa.array(list(pcd_ids)),
+                    pa.array(population),
+                    ], schema=schema))
+                rows_written += len(pcd_ids)
+
+        return rows_written
+
+    with open(path, 'w') as csv_file:
+        writer = csv.writer(csv_file, lineterminator='\n')
+        writer.writerow(['year', 'lad', 'id', 'population'])
+        for year, lad_ids, pcd_ids, population in chunks:
+            writer.writerows(zip([year] * len(pcd_ids), lad_ids, pcd_ids,
+                population.tolist()))
+            rows_written += len(pcd_ids)
+
+    return rows_written
+
+
+def allocate_4G_coverage(postcode_sectors, lad_lut, coverage=None,
+    scenario='4G_geo_out_4'):
+    """
+    Allocate 4G coverage to the densest postcode sectors in each lad,
+    until the lad's `scenario` coverage percentage of area is reached.
 
-        ranked_postcode_sectors = sorted(
-            sectors_in_lad, key=lambda x: x['properties']['pop_density_km2'], reverse=True
-            )
+    """
+    postcode_sectors, lte = allocate_4G_coverage_scenarios(
+        postcode_sectors, lad_lut, coverage, [scenario]
+        )
 
-        area_allocated = 0
+    return postcode_sectors.assign(lte=lte[scenario])
 
-        for sector in ranked_postcode_sectors:
 
-            area = sector['properties']['area_km2']
-            total = area + area_allocated
+def allocate_4G_coverage_scenarios(postcode_sectors, lad_lut, coverage=None,
+    scenarios=COVERAGE_SCENARIOS):
+    """
+    Allocate 4G coverage for several Ofcom coverage scenarios in one pass.
 
-            if total < covered_area:
+    Sectors are ranked by population density within each lad once. A
+    sector is covered when the cumulative area of it and every denser
+    sector in its lad is below the lad's covered area for that scenario.
+    Lads missing from the coverage data (or with a blank value) get no
+    coverage, and are listed in a printed summary.
 
-                sector['properties']['lte'] = 1
-                output.append(sector)
-                area_allocated += area
+    Returns the ranked postcode sectors (in `lad_lut` order, densest
+    first), and a dict of scenario to an lte array aligned with them.
 
-            else:
+    """
+    if coverage is None:
+        coverage = read_coverage_table()
 
-                sector['properties']['lte'] = 0
-                output.append(sector)
+    lad_ids = list(lad_lut)
+    lad_position = dict((lad_id, i) for i, lad_id in enumerate(lad_ids))
 
-                continue
+    position = np.array(
+        [lad_position.get(lad_id, -1) for lad_id in postcode_sectors.lad],
+        dtype=np.intp
+        )
 
-    return output
+    rows = np.flatnonzero((position >= 0) & ~np.isnan(postcode_sectors.density))
+    rows = rows[np.lexsort((-postcode_sectors.density[rows], position[rows]))]
 
+    area = postcode_sectors.area[rows]
+    lads = GroupBy(position[rows])
 
-def get_postcode_sectors_in_lad(postcode_sectors, lad_id):
+    lad_area = lads.sum(area)
+    lad_start = np.cumsum(lad_area) - lad_area
+    cumulative_area = np.cumsum(area) - lads.broadcast(lad_start)
 
-    for postcode_sector in postcode_sectors:
-        if postcode_sector['properties']['lad'] == lad_id:
-            if isinstance(postcode_sector['properties']['pop_density_km2'], float):
-                yield postcode_sector
+    ranked_lad_ids = [lad_ids[i] for i in lads.keys]
+    coverage_amount = coverage.lookup(ranked_lad_ids, scenarios)
 
+    missing = [
+        lad_id for lad_id, amount in zip(ranked_lad_ids, coverage_amount)
+        if np.isnan(amount).any()
+        ]
+    if len(missing) > 0:
+        print('- {} lads without coverage data, whose postcode sectors get no '
+            '4G coverage: {}'.format(len(missing), ', '.join(missing)))
+    covered_area = lad_area[:, np.newaxis] * (coverage_amount / 100)
 
-def import_sitefinder_data(path):
+    lte = {}
+    for i, scenario in enumerate(scenarios):
+        lte[scenario] = (
+            cumulative_area < lads.broadcast(covered_area[:, i])
+            ).astype(int)
+
+    return postcode_sectors.take(rows), lte
+
+
+def import_sitefinder_data(path, operators=('O2', 'Vodafone'), anttypes=None):
     """
     Import sitefinder data, selecting desired asset types.
         - Select sites belonging to main operators:
@@ -320,121 +532,68 @@ def import_sitefinder_data(path):
             - Includes 'Macro', 'SECTOR', 'Sectored' and 'Directional'
             - Excludes 'micro', 'microcell', 'omni' or 'pico' antenna types.
 
-    """
-    asset_data = []
-
-    site_id = 0
-
-    with open(os.path.join(path), 'r') as system_file:
-        reader = csv.DictReader(system_file)
-        next(reader, None)
-        for line in reader:
-            # if line['Operator'] != 'Airwave' and line['Operator'] != 'Network Rail':
-            if line['Operator'] == 'O2' or line['Operator'] == 'Vodafone':
-                # if line['Anttype'] == 'MACRO' or \
-                #     line['Anttype'] == 'SECTOR' or \
-                #     line['Anttype'] == 'Sectored' or \
-                #     line['Anttype'] == 'Directional':
-                asset_data.append({
-                    'type': "Feature",
-                    'geometry': {
-                        "type": "Point",
-                        "coordinates": [float(line['X']), float(line['Y'])]
-                    },
-                    'properties':{
-                        'name': 'site_' + str(site_id),
-                        'Operator': line['Operator'],
-                        'Opref': line['Opref'],
-                        'Sitengr': line['Sitengr'],
-                        'Antennaht': line['Antennaht'],
-                        'Transtype': line['Transtype'],
-                        'Freqband': line['Freqband'],
-                        'Anttype': line['Anttype'],
-                        'Powerdbw': line['Powerdbw'],
-                        'Maxpwrdbw': line['Maxpwrdbw'],
-                        'Maxpwrdbm': line['Maxpwrdbm'],
-                        'Sitelat': float(line['Sitelat']),
-                        'Sitelng': float(line['Sitelng']),
-                    }
-                })
+    Rows are streamed and filtered by `operators` and `anttypes` (None
+    for all) before parsing. Returns a Sites table of name, operator and
+    coordinates.
 
-            site_id += 1
-
-        else:
-            pass
-
-    return asset_data
+    """
+    return Sites.from_records(
+        read_sitefinder(path, operators=operators, anttypes=anttypes)
+        )
 
 
-def process_asset_data(data):
+def process_asset_data(data, buffer=50):
     """
     Add buffer to each site, dissolve overlaps and take centroid.
 
+    Sites whose buffers overlap (within 2 x `buffer` of each other) are
+    grouped transitively into one cluster, found with a KD-tree rather
+    than testing every pair of buffers. Each cluster is named after its
+    first site. Returns a Sites table.
+
     """
-    buffered_assets = []
+    if not isinstance(data, Sites):
+        data = Sites.from_features(data)
 
-    for asset in data:
-        asset_geom = shape(asset['geometry'])
-        buffered_geom = asset_geom.buffer(50)
+    if len(data) == 0:
+        return Sites([], [], [])
 
-        asset['buffer'] = buffered_geom
-        buffered_assets.append(asset)
+    coords = data.coords()
 
-    output = []
-    assets_seen = set()
-
-    for asset in buffered_assets:
-        if asset['properties']['Opref'] in assets_seen:
-            continue
-        assets_seen.add(asset['properties']['Opref'])
-        touching_assets = []
-        for other_asset in buffered_assets:
-            if asset['buffer'].intersects(other_asset['buffer']):
-                touching_assets.append(other_asset)
-                assets_seen.add(other_asset['properties']['Opref'])
-
-        dissolved_shape = cascaded_union([a['buffer'] for a in touching_assets])
-        final_centroid = dissolved_shape.centroid
-        output.append({
-            'type': "Feature",
-            'geometry': {
-                "type": "Point",
-                "coordinates": [final_centroid.coords[0][0], final_centroid.coords[0][1]],
-            },
-            'properties':{
-                'name': asset['properties']['name'],
-            }
-        })
+    labels = cluster_points(coords, 2 * buffer)
+    cluster_centroids = dissolved_centroids(coords, labels, buffer)
 
-    return output
+    _, first = np.unique(labels, return_index=True)
+
+    return Sites(
+        data.name[first],
+        cluster_centroids[:, 0],
+        cluster_centroids[:, 1],
+        )
 
 
 def add_coverage_to_sites(sitefinder_data, postcode_sectors):
+    """
+    Attach the id and 4G coverage of the intersecting postcode sector to
+    each site.
 
-    final_sites = []
+    All sites are located in one bulk points-in-polygons query, and the
+    resulting (sector, site) index pairs select rows from both tables. A
+    site on a sector boundary appears once per sector it touches.
 
-    idx = index.Index(
-        (i, shape(site['geometry']).bounds, site)
-        for i, site in enumerate(sitefinder_data)
-    )
+    """
+    if not isinstance(sitefinder_data, Sites):
+        sitefinder_data = Sites.from_features(sitefinder_data)
+
+    sector_idx, site_idx = polygon_point_pairs(
+        postcode_sectors.geometry,
+        shapely.points(sitefinder_data.coords()),
+        )
 
-    for postcode_sector in postcode_sectors:
-        for n in idx.intersection(
-            (shape(postcode_sector['geometry']).bounds), objects=True):
-            postcode_sector_shape = shape(postcode_sector['geometry'])
-            site_shape = shape(n.object['geometry'])
-            if postcode_sector_shape.intersects(site_shape):
-                final_sites.append({
-                    'type': 'Feature',
-                    'geometry': n.object['geometry'],
-                    'properties':{
-                        'id': postcode_sector['properties']['id'],
-                        'name': n.object['properties']['name'],
-                        'lte_4G': postcode_sector['properties']['lte']
-                        }
-                    })
-
-    return final_sites
+    return sitefinder_data.take(site_idx).assign(
+        id=postcode_sectors.id[sector_idx],
+        lte_4G=postcode_sectors.lte[sector_idx],
+        )
 
 
 def read_exchanges():
@@ -477,90 +636,342 @@ def read_exchange_areas():
             yield area
 
 
-def return_object_coordinates(object):
+def index_exchange_areas(exchange_areas, id_property='id'):
     """
-    Function for returning the coordinates of a type of object.
+    Index exchange area polygons for `generate_link_straight_line`.
+
+    Returns (exchange ids, PolygonIndex), where each area's exchange id
+    is its `id_property`, e.g. 'exchange_<OLO>'.
 
     """
-    if object['geometry']['type'] == 'Polygon':
-        origin_geom = object['representative_point']
-        x = origin_geom.x
-        y = origin_geom.y
-    elif object['geometry']['type'] == 'Point':
-        x = object['geometry']['coordinates'][0]
-        y = object['geometry']['coordinates'][1]
-    else:
-        print('non conforming geometry type {}'.format(object['geometry']['type']))
+    ids = []
+    polygons = []
+
+    for area in exchange_areas:
+        ids.append(area['properties'][id_property])
+        polygons.append(shape(area['geometry']))
+
+    return np.asarray(ids, dtype=object), PolygonIndex(polygons)
+
+
+def generate_link_straight_line(origin_points, dest_points, errors=None,
+    dest_areas=None):
+    """
+    Link each origin point to its nearest destination point with a
+    straight line.
+
+    All destinations are loaded into a KD-tree and every origin is
+    queried at once. With `dest_areas` (from `index_exchange_areas`),
+    each origin is instead linked to the destination whose area
+    contains it, found in one bulk query, and only origins outside
+    every area fall back to the nearest destination.
+
+    Returns the origins as a Sites table with `exchange_id` and
+    `backhaul_length_m` added, and the links as a Links table whose
+    LineStrings are only built when written.
+
+    Origins which cannot be linked are left out, and recorded in
+    `errors` (if a list is given) as dicts of 'name' and 'error'.
+
+    """
+    if not isinstance(origin_points, Sites):
+        origin_points = Sites.from_features(origin_points)
+
+    dest_ids = []
+    dest_coords = []
+    for dest_point in dest_points:
+        dest_ids.append(dest_point['properties']['exchange_id'])
+        dest_coords.append(dest_point['geometry']['coordinates'][:2])
+
+    dest_coords = np.asarray(dest_coords, dtype=float).reshape(-1, 2)
+    origin_coords = origin_points.coords()
+
+    failed = []
+
+    valid = np.isfinite(origin_coords).all(axis=1)
+    for i in np.flatnonzero(~valid):
+        failed.append((i, 'non-finite origin coordinates'))
+
+    if len(dest_coords) == 0:
+        for i in np.flatnonzero(valid):
+            failed.append((i, 'no destination points'))
+        valid[:] = False
+
+    rows = np.flatnonzero(valid)
+    nearest = np.full(len(rows), -1, dtype=np.intp)
+    distance = np.zeros(len(rows))
+
+    if dest_areas is not None and len(rows) > 0:
+        area_ids, area_index = dest_areas
+        dest_row = dict((dest_id, j) for j, dest_id in enumerate(dest_ids))
+        area_dest = np.array(
+            [dest_row.get(area_id, -1) for area_id in area_ids] + [-1],
+            dtype=np.intp
+            )
+        # Points outside every area are located at -1, the final entry.
+        nearest = area_dest[
+            area_index.locate(shapely.points(origin_coords[rows]))
+            ]
+        inside = nearest >= 0
+        distance[inside] = np.hypot(
+            *(origin_coords[rows[inside]] - dest_coords[nearest[inside]]).T
+            )
+
+    outside = np.flatnonzero(nearest < 0)
+    if len(outside) > 0:
+        distance[outside], nearest[outside] = cKDTree(dest_coords).query(
+            origin_coords[rows[outside]]
+            )
+
+    if failed:
+        print('- Problem with straight line link for {} origin points'.format(
+            len(failed)))
+        if errors is not None:
+            for i, error in sorted(failed):
+                errors.append({'name': origin_points.name[i], 'error': error})
 
-    return x, y
+    length = distance * 1.60934
+    exchange_ids = np.asarray(dest_ids, dtype=object)[nearest]
 
+    processed_sites = origin_points.take(rows).assign(
+        exchange_id=exchange_ids,
+        backhaul_length_m=length,
+        )
+
+    links = Links(
+        processed_sites.name, exchange_ids,
+        origin_coords[rows], dest_coords[nearest], length
+        )
 
-def generate_link_straight_line(origin_points, dest_points):
+    return processed_sites, links
+
+
+def process_lads(postcode_sectors, weights, lad_lut, coverage, sites, exchanges,
+    exchange_areas=None):
     """
-    Calculate distance between two points.
+    Run the per-lad stages for a set of lads: weights, lad population,
+    4G coverage, site coverage and backhaul. Pass indexed
+    `exchange_areas` to link sites to the exchange area they fall in.
+
+    Returns (postcode_sectors, processed_sites, backhaul_links, errors),
+    where errors lists the sites which could not be linked to an
+    exchange.
 
     """
-    idx = index.Index(
-        (i, Point(dest_point['geometry']['coordinates']).bounds, dest_point)
-        for i, dest_point in enumerate(dest_points)
+    errors = []
+
+    postcode_sectors = add_weights_to_postcode_sector(postcode_sectors, weights)
+    postcode_sectors = calculate_lad_population(postcode_sectors)
+    postcode_sectors = allocate_4G_coverage(postcode_sectors, lad_lut, coverage)
+
+    processed_sites = add_coverage_to_sites(sites, postcode_sectors)
+    processed_sites, backhaul_links = generate_link_straight_line(
+        processed_sites, exchanges, errors=errors, dest_areas=exchange_areas
         )
 
-    processed_sites = []
-    links = []
+    return postcode_sectors, processed_sites, backhaul_links, errors
 
-    for origin_point in origin_points:
 
-        try:
-            origin_x, origin_y = return_object_coordinates(origin_point)
+def run_lad_shards(postcode_sectors, weights, lad_lut, coverage, sites,
+    exchanges, workers=1, exchange_areas=None):
+    """
+    Run `process_lads` one lad at a time in a process pool, and merge
+    the results in `lad_lut` order, matching the serial output.
 
-            exchange = list(idx.nearest(
-                Point(origin_point['geometry']['coordinates']).bounds,
-                1, objects='raw'))[0]
+    Each shard holds one lad's postcode sectors, the weights with
+    matching ids, and every site within the bounds of those sectors, so
+    a site on a lad boundary is assigned in each shard whose sectors it
+    touches, as in the serial path. Coverage data, exchanges and
+    exchange areas are sent to each worker once.
 
-            dest_x, dest_y = return_object_coordinates(exchange)
+    """
+    lad_lut = list(lad_lut)
+    exchanges = list(exchanges)
 
-            # Get lengthFunction for returning the coordinates of
-            # an object given the specific type.
-            geom = LineString([
-                (origin_x, origin_y), (dest_x, dest_y)
-                ])
+    if not isinstance(sites, Sites):
+        sites = Sites.from_features(sites)
 
-            processed_sites.append({
-                'type': 'Feature',
-                'geometry': origin_point['geometry'],
-                'properties':{
-                    'id': origin_point['properties']['id'],
-                    'name': origin_point['properties']['name'],
-                    'lte_4G': origin_point['properties']['lte_4G'],
-                    'exchange_id': exchange['properties']['exchange_id'],
-                    'backhaul_length_m': geom.length * 1.60934
-                    }
-                })
+    weight_rows = {}
+    for j, weight in enumerate(weights):
+        weight_rows.setdefault(normalise_id(weight['id']), []).append(j)
 
-            links.append({
-                'type': "Feature",
-                'geometry': mapping(geom),
-                'properties': {
-                    "origin_id": origin_point['properties']['name'],
-                    "dest_id": exchange['properties']['exchange_id'],
-                    "length": geom.length * 1.60934
-                }
-            })
+    lad_sectors = postcode_sectors.group_by('lad').indices()
+    no_rows = np.array([], dtype=np.intp)
 
-        except:
-            print('- Problem with straight line link for:')
-            print(origin_point['properties'])
+    shards = []
 
-    return processed_sites, links
+    for lad_id in lad_lut:
+        shard_sectors = postcode_sectors.take(lad_sectors.get(lad_id, no_rows))
+
+        pcd_ids = set(normalise_id(pcd_id) for pcd_id in shard_sectors.id)
+        shard_weights = [
+            weights[j] for j in
+            sorted(j for pcd_id in pcd_ids for j in weight_rows.get(pcd_id, []))
+            ]
+
+        in_bounds = no_rows
+        if len(shard_sectors) > 0:
+            minx, miny, maxx, maxy = shapely.total_bounds(shard_sectors.geometry)
+            in_bounds = np.flatnonzero(
+                (sites.x >= minx) & (sites.x <= maxx) &
+                (sites.y >= miny) & (sites.y <= maxy)
+                )
+
+        shards.append((shard_sectors, shard_weights, [lad_id], sites.take(in_bounds)))
+
+    results = run_in_pool(
+        _process_lad_shard, shards, workers,
+        coverage=coverage, exchanges=exchanges, exchange_areas=exchange_areas,
+        )
+
+    return (
+        PostcodeSectors.concat([result[0] for result in results]),
+        Sites.concat([result[1] for result in results]),
+        Links.concat([result[2] for result in results]),
+        [error for result in results for error in result[3]],
+        )
+
+
+def _process_lad_shard(shard):
+    """
+    Run `process_lads` for one shard built by `run_lad_shards`.
+
+    """
+    postcode_sectors, weights, lad_ids, sites = shard
+
+    return process_lads(
+        postcode_sectors, weights, lad_ids, _WORKER['coverage'],
+        sites, _WORKER['exchanges'], _WORKER['exchange_areas']
+        )
+
+
+def process_operator_sites(sites, postcode_sectors, exchanges, buffer=50,
+    exchange_areas=None):
+    """
+    Run the site stages for one operator's sites: clustering, postcode
+    sector coverage and backhaul. Pass indexed `exchange_areas` to link
+    sites to the exchange area they fall in.
+
+    Returns (processed_sites, backhaul_links, errors), with the operator
+    kept on each processed site.
+
+    """
+    errors = []
+
+    operator = sites.operator[0] if len(sites) > 0 else None
+
+    processed_sites = process_asset_data(sites, buffer)
+    processed_sites = processed_sites.assign(
+        operator=np.full(len(processed_sites), operator, dtype=object)
+        )
+    processed_sites = add_coverage_to_sites(processed_sites, postcode_sectors)
+    processed_sites, backhaul_links = generate_link_straight_line(
+        processed_sites, exchanges, errors=errors, dest_areas=exchange_areas
+        )
+
+    return processed_sites, backhaul_links, errors
+
+
+def run_operator_shards(sites, postcode_sectors, exchanges, workers=1,
+    exchange_areas=None):
+    """
+    Partition sites by operator and run `process_operator_sites` for each
+    operator in a process pool, so sites are only clustered with sites
+    of the same operator.
+
+    Postcode sectors, exchanges and exchange areas are sent to each
+    worker once. Returns an OrderedDict of operator to (processed_sites,
+    backhaul_links, errors), in operator name order.
+
+    """
+    exchanges = list(exchanges)
+
+    if not isinstance(sites, Sites):
+        sites = Sites.from_features(sites)
+
+    operators = GroupBy(sites.operator)
+    operator_rows = operators.indices()
+    names = sorted(operator_rows)
+
+    shards = [sites.take(operator_rows[name]) for name in names]
+
+    results = run_in_pool(
+        _process_operator_shard, shards, workers,
+        postcode_sectors=postcode_sectors, exchanges=exchanges,
+        exchange_areas=exchange_areas,
+        )
+
+    return OrderedDict(zip(names, results))
+
+
+def _process_operator_shard(sites):
+    """
+    Run `process_operator_sites` for one operator's sites.
+
+    """
+    return process_operator_sites(
+        sites, _WORKER['postcode_sectors'], _WORKER['exchanges'],
+        exchange_areas=_WORKER['exchange_areas']
+        )
+
+
+def run_in_pool(func, shards, workers=1, **shared):
+    """
+    Return `func(shard)` for each shard, in shard order, running in a
+    process pool when `workers` > 1.
+
+    The `shared` data used by every shard is sent to each worker once,
+    and read by `func` from `_WORKER`.
+
+    """
+    if workers <= 1:
+        _init_worker(shared)
+        return [func(shard) for shard in shards]
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(shared,)) as pool:
+        return list(pool.map(func, shards))
+
+
+_WORKER = {}
+
+
+def _init_worker(shared):
+    """
+    Hold the data shared by every shard once in each worker.
+
+    """
+    _WORKER.clear()
+    _WORKER.update(shared)
+
+
+def operator_filename(prefix, operator):
+    """
+    Return a shapefile name for an operator's layer, e.g.
+    'processed_sites_network_rail.shp'.
+
+    """
+    return '{}_{}.shp'.format(prefix, operator.lower().replace(' ', '_'))
 
 
 def write_shapefile(data, directory, filename, crs):
     """
     Write geojson data to shapefile.
 
+    Tables (PostcodeSectors, Sites, Links) are converted to GeoJSON one
+    feature at a time as they are written.
+
     """
+    if hasattr(data, 'features'):
+        data = data.features()
+
+    data = iter(data)
+    first = next(data)
+
     prop_schema = []
-    for name, value in data[0]['properties'].items():
+    for name, value in first['properties'].items():
         fiona_prop_type = next((
             fiona_type for fiona_type, python_type in \
                 fiona.FIELD_TYPES_MAP.items() if \
@@ -572,7 +983,7 @@ def write_shapefile(data, directory, filename, crs):
     sink_driver = 'ESRI Shapefile'
     sink_crs = {'init': crs}
     sink_schema = {
-        'geometry': data[0]['geometry']['type'],
+        'geometry': first['geometry']['type'],
         'properties': OrderedDict(prop_schema)
     }
 
@@ -582,6 +993,7 @@ def write_shapefile(data, directory, filename, crs):
     with fiona.open(
         os.path.join(directory, filename), 'w',
         driver=sink_driver, crs=sink_crs, schema=sink_schema) as sink:
+        sink.write(first)
         for datum in data:
             sink.write(datum)
 
@@ -613,55 +1025,162 @@ if __name__ == "__main__":
     directory = os.path.join(BASE_PATH, 'processed')
     print('Output directory will be {}'.format(directory))
 
+    # Stage outputs are cached by a hash of their inputs, parameters and
+    # source, so unchanged stages load from disk on later runs.
+    cache = StageCache(CACHE_PATH)
+
+    # Shapefiles are read through fiona once, then from a WKB cache.
+    geometry_cache = GeometryCache(os.path.join(CACHE_PATH, 'geometry'))
+
+    # Each stage's timings, memory and record counts go into a report.
+    profiler = StageProfiler(
+        cache=cache,
+        profile_stages=PROFILE_STAGES,
+        profile_directory=os.path.join(directory, 'profiles'),
+        )
+
     print('Loading local authority district shapes')
-    lads = read_lads()[:20]
+    lads = profiler.run(read_lads, geometry_cache)[:20]
 
     print('Loading lad lookup')
-    lad_lut = lad_lut(lads)
+    lad_lut = list(lad_lut(lads))
 
     print('Loading postcode sector shapes')
     path = os.path.join(DATA_RAW, 'shapes', 'PostalSector.shp')
-    postcode_sectors = read_postcode_sectors(path)
+    postcode_sectors = profiler.run_cached(
+        read_postcode_sectors, path, lads=lads, geometry_cache=geometry_cache
+        )
 
-    print('Adding lad IDs to postcode sectors... might take a few minutes...')
-    postcode_sectors = add_lad_to_postcode_sector(postcode_sectors, lads)
+    if LAD_OVERLAY:
+        print('Splitting postcode sectors by lad area')
+        postcode_sectors = profiler.run_cached(
+            overlay_lads_on_postcode_sectors, postcode_sectors, lads
+            )
+    else:
+        print('Adding lad IDs to postcode sectors... might take a few minutes...')
+        postcode_sectors = profiler.run_cached(
+            add_lad_to_postcode_sector, postcode_sectors, lads, workers=WORKERS
+            )
 
+    # Weights are keyed by their file, so new weights rerun only the
+    # stages which depend on them.
     print('Loading in population weights' )
-    weights = load_in_weights()
-
-    print('Adding weights to postcode sectors')
-    postcode_sectors = add_weights_to_postcode_sector(postcode_sectors, weights)
-
-    print('Calculating lad population weight for each postcode sector')
-    postcode_sectors = calculate_lad_population(postcode_sectors)
+    weights = profiler.run_cached(
+        load_in_weights,
+        os.path.join(DATA_RAW, 'pcd_sector_weights', 'population_weights.csv')
+        )
 
-    print('Disaggregate 4G coverage to postcode sectors')
-    postcode_sectors = allocate_4G_coverage(postcode_sectors, lad_lut)
+    print('Loading coverage data')
+    coverage = read_coverage_table()
 
     print('Importing sitefinder data')
     folder = os.path.join(DATA_RAW, 'sitefinder')
-    sitefinder_data = import_sitefinder_data(os.path.join(folder, 'sitefinder.csv'))[:500]
-
-    print('Preprocessing sitefinder data with 50m buffer')
-    sitefinder_data = process_asset_data(sitefinder_data)
+    sitefinder_data = profiler.run_cached(
+        import_sitefinder_data, os.path.join(folder, 'sitefinder.csv'),
+        operators=OPERATORS
+        )
 
-    print('Allocate 4G coverage to sites from postcode sectors')
-    processed_sites = add_coverage_to_sites(sitefinder_data, postcode_sectors)
+    # In per-operator mode sites are clustered within each operator, in
+    # the operator worker pool.
+    if not PER_OPERATOR:
+        print('Preprocessing sitefinder data with 50m buffer')
+        sitefinder_data = profiler.run_cached(process_asset_data, sitefinder_data)
 
     print('Reading exchanges')
     exchanges = read_exchanges()
 
-    print('Reading exchange areas')
-    exchange_areas = read_exchange_areas()
+    exchange_areas = None
+    if BACKHAUL_AREAS:
+        print('Reading exchange areas')
+        exchange_areas = index_exchange_areas(read_exchange_areas())
+
+    operator_results = None
+
+    if WORKERS > 1 and not PER_OPERATOR:
+
+        print('Running per-lad stages in {} worker processes'.format(WORKERS))
+        postcode_sectors, processed_sites, backhaul_links, backhaul_errors = \
+            profiler.run(
+                run_lad_shards, postcode_sectors, weights, lad_lut, coverage,
+                sitefinder_data, exchanges, workers=WORKERS,
+                exchange_areas=exchange_areas
+                )
+
+    else:
+
+        print('Adding weights to postcode sectors')
+        postcode_sectors = profiler.run_cached(
+            add_weights_to_postcode_sector, postcode_sectors, weights
+            )
+
+        print('Calculating lad population weight for each postcode sector')
+        postcode_sectors = profiler.run_cached(
+            calculate_lad_population, postcode_sectors
+            )
+
+        print('Disaggregate 4G coverage to postcode sectors')
+        postcode_sectors = profiler.run_cached(
+            allocate_4G_coverage, postcode_sectors, lad_lut, coverage
+            )
+
+    if PER_OPERATOR:
+
+        print('Running site stages for each operator')
+        operator_results = profiler.run(
+            run_operator_shards, sitefinder_data, postcode_sectors, exchanges,
+            workers=WORKERS, exchange_areas=exchange_areas
+            )
+
+        backhaul_errors = [
+            error for result in operator_results.values() for error in result[2]
+            ]
+
+    elif WORKERS <= 1:
+
+        print('Allocate 4G coverage to sites from postcode sectors')
+        processed_sites = profiler.run_cached(
+            add_coverage_to_sites, sitefinder_data, postcode_sectors
+            )
+
+        print('Generating straight line distance from each site to its exchange')
+        backhaul_errors = []
+        processed_sites, backhaul_links = profiler.run(
+            generate_link_straight_line, processed_sites, exchanges,
+            errors=backhaul_errors, dest_areas=exchange_areas
+            )
+
+    if backhaul_errors:
+        csv_writer(backhaul_errors, directory, 'backhaul_errors.csv')
+
+    if operator_results is not None:
+
+        for operator, (processed_sites, backhaul_links, _) in \
+            operator_results.items():
+            if len(processed_sites) == 0:
+                print('No processed sites for {}'.format(operator))
+                continue
+
+            print('Writing {} sites and backhaul links to shapefile'.format(operator))
+            write_shapefile(
+                processed_sites, directory,
+                operator_filename('processed_sites', operator), crs
+                )
+            write_shapefile(
+                backhaul_links, directory,
+                operator_filename('backhaul_links', operator), crs
+                )
+
+    else:
 
-    print('Generating straight line distance from each site to the nearest exchange')
-    processed_sites, backhaul_links = generate_link_straight_line(processed_sites, exchanges)
+        print('Writing processed sites to shapefile')
+        write_shapefile(processed_sites, directory, 'processed_sites.shp', crs)
 
-    print('Writing processed sites to shapefile')
-    write_shapefile(processed_sites, directory, 'processed_sites.shp', crs)
+        print('Writing backhaul links to shapefile')
+        write_shapefile(backhaul_links, directory, 'backhaul_links.shp', crs)
 
-    print('Writing backhaul links to shapefile')
-    write_shapefile(backhaul_links, directory, 'backhaul_links.shp', crs)
+    print('Writing stage profiling report')
+    profiler.write_report(directory, 'preprocess_profile.json')
+    profiler.write_report(directory, 'preprocess_profile.csv')
 
     end = time.time()
     print('time taken: {} minutes'.format(round((end - start) / 60,2)))
@@ -0,0 +1,259 @@
+"""
+Per-stage profiling of the preprocessing pipeline.
+
+Written by Ed Oughton
+
+"""
+import os
+import sys
+import csv
+import json
+import time
+import cProfile
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class StageProfiler(object):
+    """
+    Run pipeline stages and record, for each one, wall time, CPU time,
+    resident memory and input/output record counts.
+
+    CPU time is recorded for this process and, separately, for worker
+    processes which finished during the stage (`children_cpu_time_s`).
+    `peak_rss_mb` is this process's peak resident memory during the
+    stage, sampled in a background thread (Linux only). The
+    `max_rss_so_far_mb` and `children_max_rss_so_far_mb` fields are
+    lifetime maxima from getrusage, for this process and its largest
+    finished worker, so they never fall from one stage to the next.
+
+    Stages named in `profile_stages` are also run under cProfile, with
+    the stats dumped to `<profile_directory>/<stage>.prof`. Stages run
+    through `run_cached` go through `cache` (a StageCache), and record
+    whether their output was loaded from it.
+
+    """
+    def __init__(self, cache=None, profile_stages=(), profile_directory='.'):
+        self.cache = cache
+        self.profile_stages = set(profile_stages)
+        self.profile_directory = profile_directory
+        self.stages = []
+
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run and record `func(*args, **kwargs)`.
+
+        """
+        return self.record(func.__name__, func, args, kwargs, None)
+
+
+    def run_cached(self, func, *args, **kwargs):
+        """
+        Run and record `func(*args, **kwargs)` through the stage cache.
+
+        """
+        if self.cache is None:
+            return self.run(func, *args, **kwargs)
+
+        result = self.record(
+            func.__name__, self.cache.run, (func,) + args, kwargs, args
+            )
+        self.stages[-1]['cached'] = self.cache.last_hit
+
+        return result
+
+
+    def record(self, name, func, args, kwargs, stage_args=None):
+        """
+        Call `func`, timing it and counting records in and out.
+        `stage_args` are the stage's own arguments, if `func` wraps it.
+
+        """
+        stage_args = args if stage_args is None else stage_args
+
+        profiler = None
+        if name in self.profile_stages:
+            profiler = cProfile.Profile()
+
+        sampler = RSSSampler()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        children_cpu_start = children_cpu_time()
+
+        if profiler is not None:
+            profiler.enable()
+        try:
+            with sampler:
+                result = func(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        children_cpu = children_cpu_time()
+        if children_cpu is not None:
+            children_cpu = round(children_cpu - children_cpu_start, 4)
+
+        if profiler is not None:
+            if not os.path.exists(self.profile_directory):
+                os.makedirs(self.profile_directory)
+            profiler.dump_stats(
+                os.path.join(self.profile_directory, '{}.prof'.format(name))
+                )
+
+        self.stages.append({
+            'stage': name,
+            'wall_time_s': round(wall_time, 4),
+            'cpu_time_s': round(cpu_time, 4),
+            'children_cpu_time_s': children_cpu,
+            'peak_rss_mb': sampler.peak_mb,
+            'max_rss_so_far_mb': max_rss_mb(),
+            'children_max_rss_so_far_mb': max_rss_mb(children=True),
+            'records_in': count_records(stage_args[0]) if stage_args else None,
+            'records_out': count_records(result),
+            'cached': False,
+        })
+
+        return result
+
+
+    def write_report(self, directory, filename):
+        """
+        Write the recorded stages to JSON, or CSV unless `filename` ends
+        in '.json'.
+
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        path = os.path.join(directory, filename)
+
+        if filename.endswith('.json'):
+            with open(path, 'w') as sink:
+                json.dump(self.stages, sink, indent=2)
+            return
+
+        fieldnames = list(self.stages[0].keys()) if self.stages else ['stage']
+
+        with open(path, 'w') as sink:
+            writer = csv.DictWriter(sink, fieldnames, lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(self.stages)
+
+
+def count_records(value):
+    """
+    Return the number of records in a stage input or output, or None.
+
+    For a tuple the first element is counted.
+
+    """
+    if isinstance(value, tuple) and len(value) > 0:
+        value = value[0]
+
+    if isinstance(value, (str, bytes)):
+        return None
+
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+class RSSSampler(object):
+    """
+    Context manager sampling this process's resident set size every
+    `interval` seconds in a background thread, keeping the peak in
+    `peak_mb` (None where the current RSS cannot be read).
+
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def __enter__(self):
+        self.sample()
+        if self.peak_mb is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.sample()
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+
+    def sample(self):
+        """
+        Read the current RSS and update the peak.
+
+        """
+        rss = current_rss_mb()
+        if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+            self.peak_mb = rss
+
+
+def current_rss_mb():
+    """
+    Return the current resident set size of this process in MB, or None
+    where /proc is not available.
+
+    """
+    try:
+        with open('/proc/self/statm', 'r') as source:
+            pages = int(source.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return round(pages * os.sysconf('SC_PAGE_SIZE') / 1e6, 1)
+
+
+def children_cpu_time():
+    """
+    Return the user plus system CPU time of finished child processes,
+    in seconds, or None.
+
+    """
+    if resource is None:
+        return None
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return usage.ru_utime + usage.ru_stime
+
+
+def max_rss_mb(children=False):
+    """
+    Return the lifetime peak resident set size of this process, or of
+    its largest finished child process, in MB.
+
+    """
+    if resource is None:
+        return None
+
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and kibibytes elsewhere.
+    if sys.platform == 'darwin':
+        return round(peak / 1e6, 1)
+
+    return round(peak * 1024 / 1e6, 1)
@@ -0,0 +1,393 @@
+"""
+Columnar postcode sector and lad tables.
+
+Written by Ed Oughton
+
+"""
+from collections import OrderedDict
+
+import numpy as np
+from shapely.geometry import mapping, shape
+
+from spatial import pack_wkb, unpack_wkb
+
+
+class PostcodeSectors(object):
+    """
+    Postcode sectors held as one NumPy array per attribute.
+
+    Each geometry is stored once in `geometry`, and every pipeline stage
+    returns a new table whose arrays are indexed views of the previous
+    one, so polygons are never copied. GeoJSON is only built by
+    `features()` when the table is written out.
+
+    Columns:
+        - id: postcode sector id
+        - lad: local authority district id
+        - fraction: share of the sector's area in that lad, for tables
+          holding one row per sector and lad overlap
+        - area: area in km^2
+        - population: domestic delivery points
+        - weight: share of the lad population
+        - density: population density used to rank sectors
+        - lte: 1 if the sector has 4G coverage, otherwise 0
+
+    """
+    COLUMNS = OrderedDict([
+        ('id', 'id'),
+        ('lad', 'lad'),
+        ('fraction', 'fraction'),
+        ('population', 'population'),
+        ('weight', 'weight'),
+        ('area', 'area_km2'),
+        ('density', 'pop_density_km2'),
+        ('lte', 'lte'),
+    ])
+
+    def __init__(self, id, geometry, lad=None, area=None, population=None,
+        weight=None, density=None, lte=None, fraction=None):
+
+        self.id = np.asarray(id, dtype=object)
+        self.geometry = as_object_array(geometry)
+        self.lad = None if lad is None else np.asarray(lad, dtype=object)
+        self.area = None if area is None else np.asarray(area, dtype=float)
+        self.population = (
+            None if population is None else np.asarray(population, dtype=float)
+            )
+        self.weight = None if weight is None else np.asarray(weight, dtype=float)
+        self.density = None if density is None else np.asarray(density, dtype=float)
+        self.lte = None if lte is None else np.asarray(lte, dtype=int)
+        self.fraction = None if fraction is None else np.asarray(fraction, dtype=float)
+
+        if len(self.id) != len(self.geometry):
+            raise ValueError('id and geometry columns differ in length')
+
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        Stack tables row-wise, keeping the columns held by all of them.
+
+        """
+        tables = list(tables)
+        names = [
+            name for name in tables[0].columns()
+            if all(getattr(table, name) is not None for table in tables)
+            ]
+
+        return cls(
+            geometry=np.concatenate([table.geometry for table in tables]),
+            **dict(
+                (name, np.concatenate([getattr(table, name) for table in tables]))
+                for name in names
+                )
+            )
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuild a table from the output of `to_arrays`.
+
+        """
+        columns = dict(
+            (name, arrays[name]) for name in cls.COLUMNS if name in arrays
+            )
+        geometry = unpack_wkb(arrays['geometry_wkb'], arrays['geometry_offsets'])
+
+        return cls(geometry=geometry, **columns)
+
+
+    def __len__(self):
+        return len(self.id)
+
+
+    def to_arrays(self):
+        """
+        Return the table as a dict of plain NumPy arrays, with geometry
+        packed as WKB, suitable for `np.savez`.
+
+        """
+        arrays = {}
+        for name in self.columns():
+            column = getattr(self, name)
+            arrays[name] = column.astype(str) if column.dtype == object else column
+
+        arrays['geometry_wkb'], arrays['geometry_offsets'] = pack_wkb(self.geometry)
+
+        return arrays
+
+
+    def columns(self):
+        """
+        Return the names of the columns which currently hold data.
+
+        """
+        return [name for name in self.COLUMNS if getattr(self, name) is not None]
+
+
+    def assign(self, **columns):
+        """
+        Return a new table with `columns` added or replaced.
+
+        """
+        data = dict((name, getattr(self, name)) for name in self.columns())
+        data.update(columns)
+
+        return PostcodeSectors(geometry=self.geometry, **data)
+
+
+    def group_by(self, column):
+        """
+        Return a GroupBy over the values of `column`, e.g. 'lad'.
+
+        """
+        return GroupBy(getattr(self, column))
+
+
+    def take(self, indices):
+        """
+        Return a new table holding the rows at `indices` (or a boolean mask).
+
+        """
+        indices = np.asarray(indices)
+        if indices.dtype != bool:
+            indices = indices.astype(np.intp)
+
+        return PostcodeSectors(
+            self.id[indices],
+            self.geometry[indices],
+            **{name: getattr(self, name)[indices]
+                for name in self.columns() if name != 'id'}
+            )
+
+
+    def features(self):
+        """
+        Yield each postcode sector as a GeoJSON feature.
+
+        """
+        names = self.columns()
+        columns = [getattr(self, name) for name in names]
+        keys = [self.COLUMNS[name] for name in names]
+
+        for i in range(len(self)):
+            yield {
+                'type': 'Feature',
+                'geometry': mapping(self.geometry[i]),
+                'properties': OrderedDict(
+                    (key, column[i].item() if hasattr(column[i], 'item') \
+                        else column[i])
+                    for key, column in zip(keys, columns)
+                    ),
+            }
+
+
+class Lads(object):
+    """
+    Local authority districts held as an array of names and an array of
+    shapely geometries in the same order, so lad shapes are converted
+    once when read and then used by index.
+
+    """
+    def __init__(self, name, geometry):
+        self.name = np.asarray(name, dtype=object)
+        self.geometry = as_object_array(geometry)
+
+        if len(self.name) != len(self.geometry):
+            raise ValueError('name and geometry columns differ in length')
+
+
+    @classmethod
+    def from_features(cls, features):
+        """
+        Build a table from GeoJSON features with a 'name' property.
+
+        """
+        features = list(features)
+
+        return cls(
+            [feature['properties']['name'] for feature in features],
+            [shape(feature['geometry']) for feature in features],
+            )
+
+
+    def __len__(self):
+        return len(self.name)
+
+
+    def __getitem__(self, indices):
+        return self.take(np.arange(len(self))[indices])
+
+
+    def to_arrays(self):
+        """
+        Return the table as a dict of plain NumPy arrays, with geometry
+        packed as WKB.
+
+        """
+        arrays = {'name': self.name.astype(str)}
+        arrays['geometry_wkb'], arrays['geometry_offsets'] = pack_wkb(self.geometry)
+
+        return arrays
+
+
+    def take(self, indices):
+        """
+        Return a new table holding the rows at `indices` (or a boolean mask).
+
+        """
+        indices = np.asarray(indices)
+        if indices.dtype != bool:
+            indices = indices.astype(np.intp)
+
+        return Lads(self.name[indices], self.geometry[indices])
+
+
+class GroupBy(object):
+    """
+    Linear-time group-by over a key column.
+
+    Keys are factorised once into integer codes, and each aggregation
+    is a single `np.bincount` over those codes. Aggregates are returned
+    in the order in which each key first appears.
+
+    """
+    def __init__(self, keys):
+        self.codes, self.keys = factorise(keys)
+        self.code = dict((key, code) for code, key in enumerate(self.keys))
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def count(self):
+        """
+        Return the number of rows in each group.
+
+        """
+        return np.bincount(self.codes, minlength=len(self.keys))
+
+
+    def sum(self, values):
+        """
+        Return the sum of `values` in each group.
+
+        """
+        return np.bincount(
+            self.codes, weights=np.asarray(values, dtype=float),
+            minlength=len(self.keys)
+            )
+
+
+    def broadcast(self, group_values):
+        """
+        Return a per-group array expanded back to one value per row.
+
+        """
+        return np.asarray(group_values)[self.codes]
+
+
+    def share(self, values):
+        """
+        Return each row's share of its group total.
+
+        """
+        values = np.asarray(values, dtype=float)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return values / self.broadcast(self.sum(values))
+
+
+    def indices(self):
+        """
+        Return a dict of key to the row indices in that group, in row order.
+
+        """
+        order = np.argsort(self.codes, kind='stable')
+        bounds = np.cumsum(self.count())[:-1]
+
+        return dict(zip(self.keys, np.split(order, bounds)))
+
+
+def factorise(keys):
+    """
+    Encode keys as integer codes, returning (codes, unique keys).
+
+    """
+    lookup = {}
+    codes = np.fromiter(
+        (lookup.setdefault(key, len(lookup)) for key in keys),
+        dtype=np.intp, count=len(keys)
+        )
+
+    return codes, as_object_array(lookup)
+
+
+def as_object_array(values):
+    """
+    Build a 1-d object array without NumPy unpacking geometry sequences.
+
+    """
+    values = list(values)
+    output = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        output[i] = value
+
+    return output
+
+
+def normalise_id(postcode_sector_id):
+    """
+    Strip spaces so 'AB1 2' and 'AB12' refer to the same postcode sector.
+
+    """
+    return postcode_sector_id.replace(' ', '')
+
+
+def index_join(left_keys, right_keys):
+    """
+    Inner join two key sequences using a dict index on the right keys.
+
+    Each right key is indexed once, and the left keys are joined in a
+    single pass. A left key matching several right rows is emitted once
+    per match, in right order.
+
+    Returns:
+        - left_rows: array of matched left row indices
+        - right_rows: array of matched right row indices
+        - unmatched_left: array of left row indices with no match
+        - unmatched_right: array of right row indices with no match
+
+    """
+    lookup = {}
+    for j, key in enumerate(right_keys):
+        lookup.setdefault(key, []).append(j)
+
+    left_rows = []
+    right_rows = []
+    unmatched_left = []
+    matched_right = set()
+
+    for i, key in enumerate(left_keys):
+        rows = lookup.get(key)
+        if rows is None:
+            unmatched_left.append(i)
+            continue
+        for j in rows:
+            left_rows.append(i)
+            right_rows.append(j)
+        matched_right.add(key)
+
+    unmatched_right = [
+        j for key, rows in lookup.items() if key not in matched_right
+        for j in rows
+        ]
+
+    return (
+        np.asarray(left_rows, dtype=np.intp),
+        np.asarray(right_rows, dtype=np.intp),
+        np.asarray(unmatched_left, dtype=np.intp),
+        np.sort(np.asarray(unmatched_right, dtype=np.intp)),
+        )
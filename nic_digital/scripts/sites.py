@@ -0,0 +1,368 @@
+"""
+Columnar mobile site table.
+
+Written by Ed Oughton
+
+"""
+from collections import OrderedDict
+
+import csv
+
+import numpy as np
+
+
+class Sites(object):
+    """
+    Mobile sites held as one NumPy array per attribute, with their point
+    locations in `x` and `y`. GeoJSON is only built by `features()` when
+    the table is written out.
+
+    Columns:
+        - name: site name
+        - operator: mobile network operator
+        - id: id of the postcode sector containing the site
+        - lte_4G: 1 if that postcode sector has 4G coverage, otherwise 0
+        - exchange_id: id of the exchange providing backhaul
+        - backhaul_length_m: length of the backhaul link
+
+    """
+    COLUMNS = [
+        'id', 'name', 'operator', 'lte_4G', 'exchange_id', 'backhaul_length_m'
+        ]
+
+    def __init__(self, name, x, y, id=None, operator=None, lte_4G=None,
+        exchange_id=None, backhaul_length_m=None):
+
+        self.name = np.asarray(name, dtype=object)
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+
+        self.id = None if id is None else np.asarray(id, dtype=object)
+        self.operator = (
+            None if operator is None else np.asarray(operator, dtype=object)
+            )
+        self.lte_4G = None if lte_4G is None else np.asarray(lte_4G, dtype=int)
+        self.exchange_id = (
+            None if exchange_id is None else np.asarray(exchange_id, dtype=object)
+            )
+        self.backhaul_length_m = (
+            None if backhaul_length_m is None else
+            np.asarray(backhaul_length_m, dtype=float)
+            )
+
+        if not len(self.name) == len(self.x) == len(self.y):
+            raise ValueError('name and coordinate columns differ in length')
+
+
+    @classmethod
+    def from_features(cls, features):
+        """
+        Build a table from GeoJSON point features with a 'name' property,
+        keeping any other table columns found in their properties.
+
+        """
+        features = list(features)
+
+        columns = {}
+        if features:
+            for name in cls.COLUMNS:
+                if name != 'name' and name in features[0]['properties']:
+                    columns[name] = [
+                        feature['properties'][name] for feature in features
+                        ]
+
+        return cls(
+            [feature['properties']['name'] for feature in features],
+            [feature['geometry']['coordinates'][0] for feature in features],
+            [feature['geometry']['coordinates'][1] for feature in features],
+            **columns
+            )
+
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Build a table from SitefinderRecords.
+
+        """
+        names = []
+        operators = []
+        x = []
+        y = []
+
+        for record in records:
+            names.append(record.name)
+            operators.append(record.operator)
+            x.append(record.x)
+            y.append(record.y)
+
+        return cls(names, x, y, operator=operators)
+
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        Stack tables row-wise, keeping the columns held by all of them.
+
+        """
+        tables = list(tables)
+        names = [
+            name for name in tables[0].columns()
+            if all(getattr(table, name) is not None for table in tables)
+            ]
+
+        return cls(
+            x=np.concatenate([table.x for table in tables]),
+            y=np.concatenate([table.y for table in tables]),
+            **dict(
+                (name, np.concatenate([getattr(table, name) for table in tables]))
+                for name in names
+                )
+            )
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuild a table from the output of `to_arrays`.
+
+        """
+        columns = dict(
+            (name, arrays[name]) for name in cls.COLUMNS if name in arrays
+            )
+
+        return cls(x=arrays['x'], y=arrays['y'], **columns)
+
+
+    def __len__(self):
+        return len(self.name)
+
+
+    def to_arrays(self):
+        """
+        Return the table as a dict of plain NumPy arrays, suitable for
+        `np.savez`.
+
+        """
+        arrays = {'x': self.x, 'y': self.y}
+        for name in self.columns():
+            column = getattr(self, name)
+            arrays[name] = column.astype(str) if column.dtype == object else column
+
+        return arrays
+
+
+    def coords(self):
+        """
+        Return an (n x 2) array of site coordinates.
+
+        """
+        return np.column_stack((self.x, self.y))
+
+
+    def columns(self):
+        """
+        Return the names of the columns which currently hold data.
+
+        """
+        return [name for name in self.COLUMNS if getattr(self, name) is not None]
+
+
+    def assign(self, **columns):
+        """
+        Return a new table with `columns` added or replaced.
+
+        """
+        data = dict((name, getattr(self, name)) for name in self.columns())
+        data.update(columns)
+
+        return Sites(x=self.x, y=self.y, **data)
+
+
+    def take(self, indices):
+        """
+        Return a new table holding the rows at `indices` (or a boolean mask).
+
+        """
+        indices = np.asarray(indices)
+        if indices.dtype != bool:
+            indices = indices.astype(np.intp)
+
+        return Sites(
+            x=self.x[indices],
+            y=self.y[indices],
+            **{name: getattr(self, name)[indices] for name in self.columns()}
+            )
+
+
+    def features(self):
+        """
+        Yield each site as a GeoJSON point feature.
+
+        """
+        names = self.columns()
+        columns = [getattr(self, name) for name in names]
+
+        for i in range(len(self)):
+            yield {
+                'type': 'Feature',
+                'geometry': {
+                    'type': 'Point',
+                    'coordinates': (self.x[i].item(), self.y[i].item()),
+                },
+                'properties': OrderedDict(
+                    (name, column[i].item() if hasattr(column[i], 'item') \
+                        else column[i])
+                    for name, column in zip(names, columns)
+                    ),
+            }
+
+
+class SitefinderRecord(object):
+    """
+    One Sitefinder row, reduced to the columns used downstream.
+
+    `extra` holds any further columns requested from `read_sitefinder`,
+    as a tuple of strings in the requested order.
+
+    """
+    __slots__ = ('name', 'operator', 'anttype', 'x', 'y', 'extra')
+
+    def __init__(self, name, operator, anttype, x, y, extra=()):
+        self.name = name
+        self.operator = operator
+        self.anttype = anttype
+        self.x = x
+        self.y = y
+        self.extra = extra
+
+
+def read_sitefinder(path, operators=None, anttypes=None, columns=()):
+    """
+    Stream Sitefinder rows as SitefinderRecords.
+
+    Rows are filtered on their raw `Operator` and `Anttype` values before
+    anything else is parsed, and only the coordinates plus any `columns`
+    requested are kept. `operators` and `anttypes` are collections of
+    accepted values, or None to accept all.
+
+    Sites are named 'site_<n>', numbering every row after the first data
+    row whether or not it is selected, so names match across filters.
+
+    """
+    operators = None if operators is None else set(operators)
+    anttypes = None if anttypes is None else set(anttypes)
+
+    with open(path, 'r') as source:
+        reader = csv.reader(source)
+        header = next(reader)
+        next(reader, None)
+
+        operator_col = header.index('Operator')
+        anttype_col = header.index('Anttype')
+        x_col = header.index('X')
+        y_col = header.index('Y')
+        extra_cols = [header.index(column) for column in columns]
+
+        for site_id, line in enumerate(reader):
+            operator = line[operator_col]
+            if operators is not None and operator not in operators:
+                continue
+            anttype = line[anttype_col]
+            if anttypes is not None and anttype not in anttypes:
+                continue
+
+            yield SitefinderRecord(
+                'site_' + str(site_id),
+                operator,
+                anttype,
+                float(line[x_col]),
+                float(line[y_col]),
+                tuple(line[col] for col in extra_cols),
+                )
+
+
+class Links(object):
+    """
+    Straight-line links between origin and destination points, held as
+    coordinate and id arrays. LineString features are only built by
+    `features()` when the links are written out.
+
+    """
+    def __init__(self, origin_id, dest_id, origin_coords, dest_coords, length):
+        self.origin_id = np.asarray(origin_id, dtype=object)
+        self.dest_id = np.asarray(dest_id, dtype=object)
+        self.origin_coords = np.asarray(origin_coords, dtype=float).reshape(-1, 2)
+        self.dest_coords = np.asarray(dest_coords, dtype=float).reshape(-1, 2)
+        self.length = np.asarray(length, dtype=float)
+
+
+    @classmethod
+    def concat(cls, links):
+        """
+        Stack several Links row-wise.
+
+        """
+        links = list(links)
+
+        return cls(
+            np.concatenate([link.origin_id for link in links]),
+            np.concatenate([link.dest_id for link in links]),
+            np.concatenate([link.origin_coords for link in links]),
+            np.concatenate([link.dest_coords for link in links]),
+            np.concatenate([link.length for link in links]),
+            )
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuild links from the output of `to_arrays`.
+
+        """
+        return cls(
+            arrays['origin_id'], arrays['dest_id'],
+            arrays['origin_coords'], arrays['dest_coords'], arrays['length']
+            )
+
+
+    def __len__(self):
+        return len(self.origin_id)
+
+
+    def to_arrays(self):
+        """
+        Return the links as a dict of plain NumPy arrays, suitable for
+        `np.savez`.
+
+        """
+        return {
+            'origin_id': self.origin_id.astype(str),
+            'dest_id': self.dest_id.astype(str),
+            'origin_coords': self.origin_coords,
+            'dest_coords': self.dest_coords,
+            'length': self.length,
+        }
+
+
+    def features(self):
+        """
+        Yield each link as a GeoJSON LineString feature.
+
+        """
+        for i in range(len(self)):
+            yield {
+                'type': 'Feature',
+                'geometry': {
+                    'type': 'LineString',
+                    'coordinates': (
+                        tuple(self.origin_coords[i].tolist()),
+                        tuple(self.dest_coords[i].tolist()),
+                        ),
+                },
+                'properties': OrderedDict([
+                    ('origin_id', self.origin_id[i]),
+                    ('dest_id', self.dest_id[i]),
+                    ('length', self.length[i].item()),
+                ]),
+            }
@@ -0,0 +1,430 @@
+"""
+Bulk spatial queries over arrays of shapely geometries.
+
+Written by Ed Oughton
+
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import Delaunay, QhullError, cKDTree
+from shapely import STRtree
+
+
+class PolygonIndex(object):
+    """
+    STRtree over a set of polygons, each prepared once.
+
+    """
+    def __init__(self, polygons):
+        self.polygons = np.asarray(polygons, dtype=object)
+        shapely.prepare(self.polygons)
+        self.tree = STRtree(self.polygons)
+
+
+    def __getstate__(self):
+        # Pickle the polygons as WKB, and rebuild the prepared polygons
+        # and tree on load, so the index can be sent to worker processes.
+        return shapely.to_wkb(self.polygons)
+
+
+    def __setstate__(self, polygons_wkb):
+        self.__init__(shapely.from_wkb(polygons_wkb))
+
+
+    def locate(self, points):
+        """
+        Return, for each point, the index of the polygon it intersects,
+        or -1. A point on a shared boundary goes to the polygon with the
+        lowest index.
+
+        """
+        points = np.asarray(points, dtype=object)
+        output = np.full(len(points), -1, dtype=np.intp)
+
+        if len(points) == 0 or len(self.polygons) == 0:
+            return output
+
+        point_idx, polygon_idx = self.tree.query(points)
+        hits = shapely.intersects(self.polygons[polygon_idx], points[point_idx])
+        point_idx = point_idx[hits]
+        polygon_idx = polygon_idx[hits]
+
+        # Keep the lowest polygon index for each point.
+        order = np.lexsort((polygon_idx, point_idx))
+        point_idx = point_idx[order]
+        polygon_idx = polygon_idx[order]
+        first = np.r_[True, point_idx[1:] != point_idx[:-1]]
+        output[point_idx[first]] = polygon_idx[first]
+
+        return output
+
+
+def polygon_point_pairs(polygons, points):
+    """
+    Return every (polygon index, point index) pair where the polygon
+    intersects the point, sorted by polygon and then point.
+
+    The points are indexed in an STRtree and queried with all polygons
+    in one call, each polygon prepared once.
+
+    """
+    points = np.asarray(points, dtype=object)
+    polygons = np.asarray(polygons, dtype=object)
+
+    if len(points) == 0 or len(polygons) == 0:
+        empty = np.array([], dtype=np.intp)
+        return empty, empty
+
+    polygon_idx, point_idx = STRtree(points).query(polygons, predicate='intersects')
+    order = np.lexsort((point_idx, polygon_idx))
+
+    return polygon_idx[order], point_idx[order]
+
+
+def polygon_overlay(polygons, overlays):
+    """
+    Return every (polygon index, overlay index) pair whose intersection
+    has area, sorted by polygon and then overlay, with the intersection
+    geometry of each pair.
+
+    Candidate pairs come from one STRtree query. Pairs where the overlay
+    contains the whole polygon keep the polygon itself, and the rest are
+    intersected in one vectorised call.
+
+    """
+    polygons = np.asarray(polygons, dtype=object)
+    overlays = np.asarray(overlays, dtype=object)
+
+    if len(polygons) == 0 or len(overlays) == 0:
+        empty = np.array([], dtype=np.intp)
+        return empty, empty, np.array([], dtype=object)
+
+    overlay_idx, polygon_idx = STRtree(polygons).query(
+        overlays, predicate='intersects'
+        )
+    order = np.lexsort((overlay_idx, polygon_idx))
+    polygon_idx = polygon_idx[order]
+    overlay_idx = overlay_idx[order]
+
+    shapely.prepare(overlays)
+    inside = shapely.contains(overlays[overlay_idx], polygons[polygon_idx])
+
+    pieces = polygons[polygon_idx]
+    pieces[~inside] = shapely.intersection(
+        pieces[~inside], overlays[overlay_idx[~inside]]
+        )
+
+    keep = shapely.area(pieces) > 0
+
+    return polygon_idx[keep], overlay_idx[keep], pieces[keep]
+
+
+def points_in_polygons(points, polygons, workers=1):
+    """
+    Return, for each point, the index of the polygon it intersects, or -1.
+
+    With `workers` > 1 the points are split into spatially coherent
+    chunks and located in a process pool. Each worker builds the polygon
+    index once, and chunk results are merged back in point order, so the
+    output is the same as the serial path.
+
+    """
+    points = np.asarray(points, dtype=object)
+
+    if workers <= 1 or len(points) < 2 * workers:
+        return PolygonIndex(polygons).locate(points)
+
+    coords = shapely.get_coordinates(points)
+    order = spatial_order(coords)
+    chunks = np.array_split(order, workers * 4)
+
+    output = np.full(len(points), -1, dtype=np.intp)
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_polygon_index,
+        initargs=(shapely.to_wkb(np.asarray(polygons, dtype=object)),)) as pool:
+        results = pool.map(_locate_chunk, [coords[chunk] for chunk in chunks])
+        for chunk, result in zip(chunks, results):
+            output[chunk] = result
+
+    return output
+
+
+def spatial_order(coords, bits=16):
+    """
+    Return the indices that sort (x, y) coordinates along a Z-order
+    (Morton) curve, so neighbouring indices are close in space.
+
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+
+    if len(coords) == 0:
+        return np.array([], dtype=np.intp)
+
+    low = coords.min(axis=0)
+    span = np.maximum(coords.max(axis=0) - low, 1e-9)
+    cells = ((coords - low) / span * ((1 << bits) - 1)).astype(np.uint64)
+
+    code = np.zeros(len(coords), dtype=np.uint64)
+    for bit in range(bits):
+        mask = np.uint64(1 << bit)
+        code |= (cells[:, 0] & mask) << np.uint64(bit)
+        code |= (cells[:, 1] & mask) << np.uint64(bit + 1)
+
+    return np.argsort(code, kind='stable')
+
+
+def nearest_pairs(origins, targets, k):
+    """
+    Link each (x, y) origin to its `k` nearest (x, y) targets in one
+    KD-tree query.
+
+    Returns (origin index, target index, length) arrays, sorted by
+    origin and then by distance. Origins get fewer than `k` links when
+    there are fewer than `k` targets.
+
+    """
+    origins = np.asarray(origins, dtype=float).reshape(-1, 2)
+    targets = np.asarray(targets, dtype=float).reshape(-1, 2)
+    k = min(k, len(targets))
+
+    if len(origins) == 0 or k == 0:
+        empty = np.array([], dtype=np.intp)
+        return empty, empty, np.array([], dtype=float)
+
+    length, target_idx = cKDTree(targets).query(origins, k=k)
+
+    return (
+        np.repeat(np.arange(len(origins)), k),
+        target_idx.reshape(-1).astype(np.intp),
+        length.reshape(-1),
+        )
+
+
+def cluster_points(coords, distance):
+    """
+    Group (x, y) points into clusters of points within `distance` of
+    each other, following chains of neighbours transitively.
+
+    Neighbouring pairs are found with a KD-tree, and pairs are merged
+    into clusters as connected components (union-find). Returns one
+    cluster label per point, numbered in order of each cluster's first
+    point.
+
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    n = len(coords)
+
+    if n == 0:
+        return np.array([], dtype=np.intp)
+
+    pairs = cKDTree(coords).query_pairs(distance, output_type='ndarray')
+    graph = coo_matrix(
+        (np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+        shape=(n, n)
+        )
+    _, labels = connected_components(graph, directed=False)
+
+    # Renumber so clusters follow the order of their first point.
+    _, first = np.unique(labels, return_index=True)
+    rank = np.empty(len(first), dtype=np.intp)
+    rank[np.argsort(first)] = np.arange(len(first))
+
+    return rank[labels]
+
+
+def euclidean_mst(coords):
+    """
+    Return the Euclidean minimum spanning tree of (x, y) points as
+    (i, j, length) arrays, one entry per tree edge with i < j, in
+    ascending order of length and then of (i, j).
+
+    Candidate edges come from a Delaunay triangulation, which holds
+    every minimum spanning tree edge, so only O(n) edges are sorted and
+    merged by Kruskal's algorithm. Coincident points are joined to the
+    first of them by zero-length edges. Points so close to another that
+    Qhull leaves them out of the triangulation (its `coplanar` points)
+    are joined to their nearest vertex and to that vertex's neighbours.
+    If the distinct points are all collinear, consecutive points along
+    the line are the candidates.
+
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+
+    # Triangulate one representative (the first) of each distinct point.
+    _, first, inverse = np.unique(
+        coords, axis=0, return_index=True, return_inverse=True
+        )
+    inverse = inverse.reshape(-1)
+    representative = first[inverse]
+
+    edges = [np.column_stack((
+        representative[representative != np.arange(len(coords))],
+        np.flatnonzero(representative != np.arange(len(coords))),
+        ))]
+
+    points = np.sort(first)
+
+    if len(points) > 1:
+        try:
+            tri = Delaunay(coords[points])
+            simplices = tri.simplices
+            pairs = [
+                simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]]
+                ]
+
+            if len(tri.coplanar) > 0:
+                indptr, neighbours = tri.vertex_neighbor_vertices
+                point, vertex = tri.coplanar[:, 0], tri.coplanar[:, 2]
+                counts = indptr[vertex + 1] - indptr[vertex]
+                pairs.append(np.column_stack((point, vertex)))
+                pairs.append(np.column_stack((
+                    np.repeat(point, counts),
+                    neighbours[np.concatenate(
+                        [np.arange(indptr[v], indptr[v + 1]) for v in vertex]
+                        )],
+                    )))
+
+            pairs = np.concatenate(pairs)
+        except QhullError:
+            order = np.lexsort((coords[points, 1], coords[points, 0]))
+            pairs = np.column_stack((order[:-1], order[1:]))
+
+        edges.append(points[pairs])
+
+    edges = np.unique(np.sort(np.concatenate(edges), axis=1), axis=0)
+
+    i = edges[:, 0]
+    j = edges[:, 1]
+    dx = coords[j, 0] - coords[i, 0]
+    dy = coords[j, 1] - coords[i, 1]
+    length = np.sqrt(dx * dx + dy * dy)
+
+    order = np.lexsort((j, i, length))
+
+    # Kruskal's algorithm over the sorted candidates, with a union-find.
+    parent = list(range(len(coords)))
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    tree = []
+    for edge in order.tolist():
+        root_i = find(int(i[edge]))
+        root_j = find(int(j[edge]))
+        if root_i != root_j:
+            parent[root_j] = root_i
+            tree.append(edge)
+            if len(tree) == len(coords) - 1:
+                break
+
+    assert len(tree) == max(len(coords) - 1, 0), \
+        'minimum spanning tree is disconnected'
+
+    tree = np.asarray(tree, dtype=np.intp)
+
+    return i[tree], j[tree], length[tree]
+
+
+def dissolved_centroids(coords, labels, buffer):
+    """
+    Buffer each point, dissolve the buffers in each cluster and return
+    the (x, y) centroid of every cluster, in label order.
+
+    Single-point clusters are the point itself, so only points in shared
+    clusters are buffered.
+
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    labels = np.asarray(labels, dtype=np.intp)
+
+    n_clusters = labels.max() + 1 if len(labels) else 0
+    output = np.empty((n_clusters, 2))
+
+    sizes = np.bincount(labels, minlength=n_clusters)
+    single = sizes[labels] == 1
+    output[labels[single]] = coords[single]
+
+    shared = np.flatnonzero(~single)
+    shared = shared[np.argsort(labels[shared], kind='stable')]
+    buffers = shapely.buffer(shapely.points(coords[shared]), buffer)
+    bounds = np.flatnonzero(np.diff(labels[shared])) + 1
+
+    for label, cluster in zip(
+        np.unique(labels[shared]), np.split(np.arange(len(shared)), bounds)):
+        centroid = shapely.union_all(buffers[cluster]).centroid
+        output[label] = (centroid.x, centroid.y)
+
+    return output
+
+
+_POLYGON_INDEX = None
+
+
+def _init_polygon_index(polygons_wkb):
+    """
+    Build the polygon index once in each worker process.
+
+    """
+    global _POLYGON_INDEX
+    _POLYGON_INDEX = PolygonIndex(shapely.from_wkb(polygons_wkb))
+
+
+def _locate_chunk(coords):
+    """
+    Locate a chunk of (x, y) coordinates in the worker's polygon index.
+
+    """
+    return _POLYGON_INDEX.locate(shapely.points(coords))
+
+
+def pack_wkb(geometries):
+    """
+    Encode geometries as one WKB byte blob plus an offsets array, where
+    geometry i is blob[offsets[i]:offsets[i + 1]].
+
+    """
+    wkb = shapely.to_wkb(np.asarray(geometries, dtype=object))
+    offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in wkb])
+    blob = np.frombuffer(b''.join(wkb), dtype=np.uint8)
+
+    return blob, offsets
+
+
+def unpack_wkb(blob, offsets, indices=None):
+    """
+    Decode geometries (all, or those at `indices`) from `pack_wkb` output.
+
+    """
+    if indices is None:
+        indices = range(len(offsets) - 1)
+
+    blob = np.asarray(blob, dtype=np.uint8)
+    wkb = [blob[offsets[i]:offsets[i + 1]].tobytes() for i in indices]
+
+    return shapely.from_wkb(np.array(wkb, dtype=object))
+
+
+def centroids(geometries):
+    """
+    Return the centroid of every geometry in one vectorised call.
+
+    """
+    return shapely.centroid(np.asarray(geometries, dtype=object))
+
+
+def areas(geometries):
+    """
+    Return the area of every geometry in one vectorised call.
+
+    """
+    return shapely.area(np.asarray(geometries, dtype=object))
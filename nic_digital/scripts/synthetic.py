@@ -0,0 +1,327 @@
+"""
+Generate synthetic preprocessing inputs at a configurable scale.
+
+Writes stand-ins for the licensed OS, Ofcom, Sitefinder and exchange
+data, in the layout and columns read by preprocess.py:
+
+    raw/shapes/lad_uk_2016-12.shp
+    raw/shapes/PostalSector.shp
+    raw/pcd_sector_weights/population_weights.csv
+    raw/ofcom_2018/201809_mobile_laua_r02.csv
+    raw/sitefinder/sitefinder.csv
+    raw/exchanges/final_exchange_pcds.csv
+    raw/exchanges/_exchange_areas_fixed.shp
+
+Lads, postcode sectors and exchange areas are Voronoi cells over the
+same square extent, so postcode sectors straddle lad boundaries as real
+ones do.
+
+Usage:
+    python synthetic.py <base_path> [scale]
+
+Written by Ed Oughton
+
+"""
+import os
+import sys
+import csv
+
+import fiona
+import numpy as np
+import shapely
+from shapely.geometry import box, mapping
+
+# Approximate UK counts.
+NATIONAL = {
+    'lads': 391,
+    'postcode_sectors': 11200,
+    'sites': 130000,
+    'exchanges': 5600,
+}
+
+# Lads in the regional run made by preprocess.py's __main__.
+REGIONAL_LADS = 20
+
+# Named scales, as fractions of NATIONAL. '1x' is the size of the
+# regional run, '10x' ten times that, and 'national' the whole UK.
+SCALES = {
+    '1x': REGIONAL_LADS / NATIONAL['lads'],
+    '10x': 10 * REGIONAL_LADS / NATIONAL['lads'],
+    'national': 1.0,
+}
+
+# Area covered by each lad, in metres.
+LAD_SIDE = 25000
+
+# Latitude and longitude of the south west corner of the synthetic
+# extent, used to give each site plausible Sitelat and Sitelng values.
+ORIGIN_LAT = 50.5
+ORIGIN_LNG = -4.0
+
+OPERATORS = [
+    ('O2', 0.25), ('Vodafone', 0.25), ('Orange', 0.15), ('T-Mobile', 0.1),
+    ('Three', 0.2), ('Airwave', 0.03), ('Network Rail', 0.02),
+    ]
+
+ANTTYPES = [
+    ('Macro', 0.6), ('SECTOR', 0.1), ('Sectored', 0.1), ('Directional', 0.05),
+    ('micro', 0.05), ('microcell', 0.04), ('omni', 0.03), ('pico', 0.03),
+    ]
+
+SITEFINDER_COLUMNS = [
+    'Operator', 'Opref', 'Sitengr', 'Antennaht', 'Transtype', 'Freqband',
+    'Anttype', 'Powerdbw', 'Maxpwrdbw', 'Maxpwrdbm', 'Sitelat', 'Sitelng',
+    'X', 'Y',
+    ]
+
+CRS = 'epsg:27700'
+
+
+def scale_counts(scale):
+    """
+    Return the number of each record type for `scale`, either a name in
+    SCALES or a fraction of NATIONAL.
+
+    """
+    fraction = SCALES[scale] if scale in SCALES else float(scale)
+
+    return dict(
+        (name, max(1, int(round(count * fraction))))
+        for name, count in NATIONAL.items()
+        )
+
+
+def voronoi_cells(seeds, extent):
+    """
+    Return the Voronoi cell of each seed point, clipped to `extent`, in
+    the order of `seeds`.
+
+    """
+    cells = shapely.get_parts(
+        shapely.voronoi_polygons(shapely.multipoints(seeds), extend_to=extent)
+        )
+    cells = shapely.intersection(cells, extent)
+
+    # Cells are not returned in seed order, so match each seed to its cell.
+    seed_idx, cell_idx = shapely.STRtree(cells).query(
+        shapely.points(seeds), predicate='intersects'
+        )
+    _, first = np.unique(seed_idx, return_index=True)
+
+    return cells[cell_idx[first]]
+
+
+def write_polygons(path, geometries, properties, schema):
+    """
+    Write polygons and their property dicts to a shapefile.
+
+    """
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with fiona.open(
+        path, 'w', driver='ESRI Shapefile', crs=CRS,
+        schema={'geometry': 'Polygon', 'properties': schema}) as sink:
+        for geometry, item in zip(geometries, properties):
+            sink.write({
+                'type': 'Feature',
+                'geometry': mapping(geometry),
+                'properties': item,
+            })
+
+
+def write_rows(path, header, rows):
+    """
+    Write a header and rows to a CSV file.
+
+    """
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path, 'w') as sink:
+        writer = csv.writer(sink, lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def to_lat_lng(x, y):
+    """
+    Convert synthetic eastings and northings (in metres from the extent's
+    south west corner) to approximate latitudes and longitudes.
+
+    """
+    lat = ORIGIN_LAT + np.asarray(y) / 111320
+    lng = ORIGIN_LNG + np.asarray(x) / (111320 * np.cos(np.radians(lat)))
+
+    return lat, lng
+
+
+def choose(rng, options, size):
+    """
+    Draw `size` values from a list of (value, probability) pairs.
+
+    """
+    values, weights = zip(*options)
+    weights = np.asarray(weights) / sum(weights)
+
+    return np.asarray(values, dtype=object)[rng.choice(len(values), size, p=weights)]
+
+
+def postcode_sector_ids(count):
+    """
+    Return `count` unique postcode sector ids, such as 'AB10 1'.
+
+    """
+    letters = 'ABCDEFGHJKLMNOPRSTUWY'
+    ids = []
+
+    for i in range(count):
+        area = letters[(i // 100) % len(letters)] + \
+            letters[(i // (100 * len(letters))) % len(letters)]
+        district = (i // 10) % 10 + 10 * (i // (100 * len(letters) ** 2))
+        ids.append('{}{} {}'.format(area, district, i % 10))
+
+    return ids
+
+
+def generate(base_path, scale='1x', seed=0):
+    """
+    Write a full set of synthetic raw inputs under `base_path`/raw, and
+    return the number of each record type written.
+
+    """
+    counts = scale_counts(scale)
+    rng = np.random.default_rng(seed)
+    raw = os.path.join(base_path, 'raw')
+
+    side = LAD_SIDE * np.sqrt(counts['lads'])
+    extent = box(0, 0, side, side)
+
+    def seeds(count):
+        return rng.uniform(0, side, (count, 2))
+
+    print('Generating {} lads'.format(counts['lads']))
+    lad_ids = ['E07{:06d}'.format(i + 1) for i in range(counts['lads'])]
+    lad_shapes = voronoi_cells(seeds(counts['lads']), extent)
+    write_polygons(
+        os.path.join(raw, 'shapes', 'lad_uk_2016-12.shp'),
+        lad_shapes,
+        [{'name': lad_id, 'desc': 'Synthetic lad {}'.format(lad_id)}
+            for lad_id in lad_ids],
+        {'name': 'str', 'desc': 'str'},
+        )
+
+    print('Generating {} postcode sectors'.format(counts['postcode_sectors']))
+    sector_seeds = seeds(counts['postcode_sectors'])
+    sector_ids = postcode_sector_ids(counts['postcode_sectors'])
+    write_polygons(
+        os.path.join(raw, 'shapes', 'PostalSector.shp'),
+        voronoi_cells(sector_seeds, extent),
+        [{'RMSect': sector_id} for sector_id in sector_ids],
+        {'RMSect': 'str'},
+        )
+
+    # Delivery points are skewed, with a few dense sectors.
+    write_rows(
+        os.path.join(raw, 'pcd_sector_weights', 'population_weights.csv'),
+        ['postcode_sector', 'domestic_delivery_points'],
+        zip(
+            [sector_id.replace(' ', '') for sector_id in sector_ids],
+            rng.lognormal(7.5, 0.8, len(sector_ids)).astype(int) + 1,
+            ),
+        )
+
+    scenarios = np.sort(rng.uniform(40, 99, (counts['lads'], 5)), axis=1)
+    write_rows(
+        os.path.join(raw, 'ofcom_2018', '201809_mobile_laua_r02.csv'),
+        ['laua', 'laua_name'] +
+        ['4G_prem_out_{}'.format(i) for i in range(5)] +
+        ['4G_geo_out_{}'.format(i) for i in range(5)],
+        [
+            [lad_id, 'Synthetic lad {}'.format(lad_id)] +
+            np.round(np.minimum(row + 5, 100), 2).tolist() +
+            np.round(row, 2).tolist()
+            for lad_id, row in zip(lad_ids, scenarios)
+        ],
+        )
+
+    # Sites sit near postcode sector seeds, and most masts host several
+    # operators within a few metres of each other.
+    print('Generating {} sitefinder rows'.format(counts['sites']))
+    masts = max(1, counts['sites'] // 2)
+    mast_xy = sector_seeds[rng.integers(0, len(sector_seeds), masts)] + \
+        rng.normal(0, 1500, (masts, 2))
+    site_xy = mast_xy[rng.integers(0, masts, counts['sites'])] + \
+        rng.normal(0, 10, (counts['sites'], 2))
+    site_xy = np.clip(site_xy, 0, side)
+
+    operators = choose(rng, OPERATORS, counts['sites'])
+    anttypes = choose(rng, ANTTYPES, counts['sites'])
+    site_lat, site_lng = to_lat_lng(site_xy[:, 0], site_xy[:, 1])
+
+    write_rows(
+        os.path.join(raw, 'sitefinder', 'sitefinder.csv'),
+        SITEFINDER_COLUMNS,
+        (
+            [operator, 'REF{:07d}'.format(i),
+                'SU{:05d}{:05d}'.format(int(x) % 100000, int(y) % 100000),
+                '15', 'GSM', '900', anttype, '20', '30', '60',
+                round(lat, 6), round(lng, 6), round(x, 1), round(y, 1)]
+            for i, (operator, anttype, (x, y), lat, lng) in
+            enumerate(zip(operators, anttypes, site_xy, site_lat, site_lng))
+        ),
+        )
+
+    print('Generating {} exchanges'.format(counts['exchanges']))
+    exchange_xy = seeds(counts['exchanges'])
+    olos = ['OLO{:05d}'.format(i) for i in range(counts['exchanges'])]
+    write_rows(
+        os.path.join(raw, 'exchanges', 'final_exchange_pcds.csv'),
+        ['OLO', 'Name', 'exchange_pcd', 'E', 'N'],
+        (
+            [olo, 'Exchange {}'.format(i), sector_ids[i % len(sector_ids)],
+                round(x, 1), round(y, 1)]
+            for i, (olo, (x, y)) in enumerate(zip(olos, exchange_xy))
+        ),
+        )
+
+    write_polygons(
+        os.path.join(raw, 'exchanges', '_exchange_areas_fixed.shp'),
+        voronoi_cells(exchange_xy, extent),
+        [{'id': 'exchange_' + olo} for olo in olos],
+        {'id': 'str'},
+        )
+
+    return counts
+
+
+def synthetic_forecast(lad_ids, years=range(2020, 2031), seed=0):
+    """
+    Return a lad population forecast, as rows of year, lad and population
+    grouped by year, for use with `disaggregate`.
+
+    """
+    rng = np.random.default_rng(seed)
+    base = rng.integers(50000, 500000, len(lad_ids))
+    growth = rng.uniform(0.995, 1.015, len(lad_ids))
+
+    return [
+        {
+            'year': year,
+            'lad': lad_id,
+            'population': int(population * rate ** (year - years[0])),
+        }
+        for year in years
+        for lad_id, population, rate in zip(lad_ids, base, growth)
+        ]
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print('Usage: python synthetic.py <base_path> [scale]')
+        sys.exit(1)
+
+    scale = sys.argv[2] if len(sys.argv) > 2 else '1x'
+    counts = generate(sys.argv[1], scale)
+    print('Wrote {} synthetic data to {}: {}'.format(scale, sys.argv[1], counts))